@@ -1,4 +1,12 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import inspect
 import io
+import itertools
+import mmap
 import os
 import base64
 from pathlib import Path
@@ -7,6 +15,7 @@ from keg_elements.encoding import force_bytes
 
 import cryptography.fernet as fernet
 import cryptography.hazmat.primitives.ciphers as ciphers
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import (
     constant_time,
@@ -14,6 +23,8 @@ from cryptography.hazmat.primitives import (
     hmac,
     padding
 )
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 from keg_elements.extensions import lazy_gettext as _
 
@@ -57,16 +68,44 @@ def aes_decryptor(key, iv, mode=None):
     return cipher.decryptor()
 
 
-def fernet_cipher(key):
-    """Build a Fernet cipher from the given key."""
+FERNET_CACHE_SIZE = 32
+
+
+@functools.lru_cache(maxsize=FERNET_CACHE_SIZE)
+def _fernet_cipher(key):
     return fernet.Fernet(base64.urlsafe_b64encode(key))
 
 
+@functools.lru_cache(maxsize=FERNET_CACHE_SIZE)
+def _multi_fernet_cipher(keys):
+    return fernet.MultiFernet([_fernet_cipher(key) for key in keys])
+
+
+def fernet_cipher(key):
+    """Build a Fernet cipher from the given key.
+
+    A list of keys builds a MultiFernet cipher, which encrypts with the first key and decrypts
+    with any of them, to allow rotating keys.
+
+    The most recently used ciphers are cached by key, so encrypting or decrypting many values
+    with the same key does not rebuild the cipher each time.
+    """
+    if isinstance(key, (list, tuple)):
+        return _multi_fernet_cipher(tuple(bytes(item) for item in key))
+    return _fernet_cipher(bytes(key))
+
+
+def clear_fernet_cache():
+    """Drop all cached Fernet ciphers, e.g. after a key is revoked."""
+    _multi_fernet_cipher.cache_clear()
+    _fernet_cipher.cache_clear()
+
+
 def encrypt(data, key):
     """
     Encrypts binary data using cryptography's default fernet algorithm
     :param data: plaintext data to encrypt
-    :param key: encryption key
+    :param key: encryption key, or a list of keys (see `fernet_cipher`)
     :return: encrypted data as a fernet token (a signed, base64 encoded string)
     """
     return fernet_cipher(key).encrypt(data)
@@ -76,12 +115,34 @@ def decrypt(data, key):
     """
     Decrypts binary data using cryptography's default fernet algorithm
     :param data: a fernet token to decrypt
-    :param key: encryption key
+    :param key: encryption key, or a list of keys (see `fernet_cipher`)
     :return: decrypted data
     """
     return fernet_cipher(key).decrypt(data)
 
 
+def encrypt_many(items, key):
+    """
+    Encrypts each item of binary data using cryptography's default fernet algorithm
+    :param items: iterable of plaintext data to encrypt
+    :param key: encryption key
+    :return: list of fernet tokens
+    """
+    cipher = fernet_cipher(key)
+    return [cipher.encrypt(data) for data in items]
+
+
+def decrypt_many(items, key):
+    """
+    Decrypts each fernet token using cryptography's default fernet algorithm
+    :param items: iterable of fernet tokens to decrypt
+    :param key: encryption key
+    :return: list of decrypted data
+    """
+    cipher = fernet_cipher(key)
+    return [cipher.decrypt(data) for data in items]
+
+
 def encrypt_str(data, key):
     """
     Encrypts a unicode string using cryptography's default fernet algorithm
@@ -120,13 +181,31 @@ def encrypt_file(key, in_fpath, out_fpath=None, chunksize=64 * 1024):
     if not out_fpath:
         out_fpath = in_fpath + '.enc'
 
-    with open(in_fpath, 'rb') as infile, open(out_fpath, 'wb') as outfile:
-        for chunk in encrypt_fileobj(key, infile, chunksize):
-            outfile.write(chunk)
+    with _input_views(in_fpath, chunksize) as views, open(out_fpath, 'wb') as outfile:
+        _encrypt_views(key, views, outfile, chunksize)
 
     return out_fpath
 
 
+def encrypt_fileobj_into(key, in_fileobj, out_fileobj, chunksize=64 * 1024):
+    """ Encrypts a file object using AES (CBC mode) with the given key, and writes the
+    contents to the given output file object.
+
+    Produces the same format as `encrypt_fileobj`, but reads into and encrypts from reused
+    buffers instead of allocating new bytes for every chunk.
+
+    :param key: The encryption key - a string that must be
+        either 16, 24 or 32 bytes long. Longer keys
+        are more secure.
+    :param in_fileobj: Readable IO stream holding plaintext contents.
+    :param out_fileobj: Writeable IO stream for encrypted contents.
+    :param chunksize: Sets the size of the chunk which the function uses to read and encrypt
+        the file. chunksize must be divisible by 16.
+    :returns: None.
+    """
+    _encrypt_views(key, _readinto_views(in_fileobj, chunksize), out_fileobj, chunksize)
+
+
 def encrypt_fileobj(key, in_fileobj, chunksize=64 * 1024):
     """ Encrypts a file object using AES (CBC mode) with the given key.
 
@@ -173,8 +252,8 @@ def decrypt_file(key, in_fpath, out_fpath=None, chunksize=24 * 1024):
         else:
             raise ValueError(_('If input file name doesn\'t end in ".enc" then output '
                                'filename must be given.'))
-    with open(in_fpath, 'rb') as infile, open(out_fpath, 'wb') as outfile:
-        decrypt_fileobj(key, infile, outfile, chunksize)
+    with _input_views(in_fpath, chunksize) as views, open(out_fpath, 'wb') as outfile:
+        _decrypt_views(key, views, outfile, chunksize)
 
     return out_fpath
 
@@ -192,9 +271,9 @@ def decrypt_bytesio(key, in_fpath, chunksize=24 * 1024):
         be divisible by 16.
     :returns: Output file path string.
     """
-    with open(in_fpath, 'rb') as infile:
+    with _input_views(in_fpath, chunksize) as views:
         bytes_fobj = io.BytesIO()
-        decrypt_fileobj(key, infile, bytes_fobj, chunksize)
+        _decrypt_views(key, views, bytes_fobj, chunksize)
     # prep for reading from the start of the file
     bytes_fobj.seek(0)
     return bytes_fobj
@@ -214,19 +293,653 @@ def decrypt_fileobj(key, in_fileobj, out_fileobj, chunksize):
         be divisible by 16.
     :returns: None.
     """
-    iv = in_fileobj.read(16)
-    decryptor = aes_decryptor(key, iv)
-    unpadder = padding.PKCS7(decryptor._ctx._cipher.block_size).unpadder()
+    _decrypt_views(key, _readinto_views(in_fileobj, chunksize), out_fileobj, chunksize)
 
-    for chunk in iter(lambda: in_fileobj.read(chunksize), b''):
-        data = decryptor.update(chunk)
-        data = unpadder.update(data)
-        out_fileobj.write(data)
 
-    out_fileobj.write(unpadder.update(decryptor.finalize()))
+def _readinto_views(fileobj, chunksize):
+    """Yield views of a reused buffer, filled with consecutive `chunksize` byte chunks of
+    the file object. Each view is only valid until the next one is yielded.
+
+    Chunks are only short at the end of the stream, where an empty view may be yielded.
+    """
+    buffer = bytearray(chunksize)
+    view = memoryview(buffer)
+    readinto = getattr(fileobj, 'readinto', None)
+    while True:
+        filled = 0
+        while filled < chunksize:
+            if readinto is not None:
+                count = readinto(view[filled:])
+            else:
+                data = fileobj.read(chunksize - filled)
+                count = len(data)
+                view[filled:filled + count] = data
+            if not count:
+                break
+            filled += count
+        yield view[:filled]
+        if filled < chunksize:
+            return
+
+
+def _mmap_views(mapped, chunksize):
+    """Yield views of consecutive `chunksize` byte chunks of a memory mapped file."""
+    with memoryview(mapped) as view:
+        for offset in range(0, len(view), chunksize):
+            chunk = view[offset:offset + chunksize]
+            try:
+                yield chunk
+            finally:
+                chunk.release()
+
+
+@contextlib.contextmanager
+def _input_views(fpath, chunksize):
+    """Open a file and provide views of its chunks, memory mapping it where possible so the
+    contents are not copied into buffers."""
+    with open(fpath, 'rb') as infile:
+        try:
+            mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty files, pipes, and file systems that don't support mapping
+            yield _readinto_views(infile, chunksize)
+            return
+
+        views = _mmap_views(mapped, chunksize)
+        try:
+            yield views
+        except BaseException:
+            views.close()
+            # don't let a view kept alive by the exception's traceback hide the exception
+            with contextlib.suppress(BufferError):
+                mapped.close()
+            raise
+        views.close()
+        mapped.close()
+
+
+def _encrypt_views(key, views, out_fileobj, chunksize):
+    encryptor, iv = aes_encryptor(key)
+    block_size = ciphers.algorithms.AES.block_size
+    padder = padding.PKCS7(block_size).padder()
+    out_buffer = bytearray(chunksize + block_size // 8 - 1)
+    out_view = memoryview(out_buffer)
+
+    out_fileobj.write(iv)
+    for chunk in views:
+        if len(chunk) < chunksize:
+            out_fileobj.write(encryptor.update(padder.update(chunk)))
+            break
+        if chunksize % (block_size // 8):
+            out_fileobj.write(encryptor.update(padder.update(chunk)))
+        else:
+            # full chunks are block aligned, so the padder has nothing buffered and can be
+            # skipped until the last chunk
+            count = encryptor.update_into(chunk, out_buffer)
+            out_fileobj.write(out_view[:count])
+
+    out_fileobj.write(encryptor.update(padder.finalize()))
+    out_fileobj.write(encryptor.finalize())
+
+
+def _decrypt_views(key, views, out_fileobj, chunksize):
+    views = iter(views)
+    iv = b''
+    remainder = b''
+    # the IV may span chunks when chunksize is smaller than the IV. The rest of the chunk is
+    # copied, as views derived from a chunk would keep its buffer from being released.
+    for chunk in views:
+        needed = 16 - len(iv)
+        iv += bytes(chunk[:needed])
+        if len(chunk) > needed:
+            remainder = bytes(chunk[needed:])
+            break
+        if len(iv) == 16:
+            break
+
+    decryptor = aes_decryptor(key, iv)
+    block_bytes = ciphers.algorithms.AES.block_size // 8
+    out_buffer = bytearray(chunksize + block_bytes - 1)
+    out_view = memoryview(out_buffer)
+
+    # the last block holds the padding, so it is held back until the end
+    held = b''
+    for chunk in itertools.chain([remainder], views):
+        count = decryptor.update_into(chunk, out_buffer)
+        if count >= block_bytes:
+            out_fileobj.write(held)
+            out_fileobj.write(out_view[:count - block_bytes])
+            held = bytes(out_view[count - block_bytes:count])
+        elif count:
+            held += bytes(out_view[:count])
+            out_fileobj.write(held[:-block_bytes])
+            held = held[-block_bytes:]
+
+    unpadder = padding.PKCS7(ciphers.algorithms.AES.block_size).unpadder()
+    out_fileobj.write(unpadder.update(held + decryptor.finalize()))
     out_fileobj.write(unpadder.finalize())
 
 
+STREAM_MAGIC = b'KEGS'
+STREAM_VERSION = 1
+STREAM_CHUNK_SIZE = 64 * 1024
+# headers are not authenticated until a chunk is decrypted, so bound what they can ask for
+STREAM_MAX_CHUNK_SIZE = 8 * 1024 * 1024
+STREAM_TAG_SIZE = 16
+_STREAM_SALT_SIZE = 16
+_STREAM_PREFIX_SIZE = 7
+STREAM_HEADER_SIZE = len(STREAM_MAGIC) + 1 + 4 + _STREAM_SALT_SIZE + _STREAM_PREFIX_SIZE
+
+
+class _StreamParams:
+    """Header fields and cipher of a chunked AES-GCM stream.
+
+    The header is ``magic | version | chunk size | salt | nonce prefix``. Chunks are encrypted
+    with a key derived from the given key and the salt, so nonces never repeat across streams
+    encrypted with the same key. Each chunk's nonce is ``prefix | counter | final flag`` and
+    the header is authenticated with every chunk, so chunks can't be reordered, truncated,
+    or moved between streams without failing to decrypt.
+    """
+
+    def __init__(self, key, chunksize, salt, prefix):
+        self.chunksize = chunksize
+        self.segment_size = chunksize + STREAM_TAG_SIZE
+        self.prefix = prefix
+        self.header = (
+            STREAM_MAGIC
+            + bytes([STREAM_VERSION])
+            + chunksize.to_bytes(4, 'big')
+            + salt
+            + prefix
+        )
+        stream_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            info=b'keg_elements.crypto stream',
+            backend=default_backend(),
+        ).derive(bytes(key))
+        self.aead = AESGCM(stream_key)
+
+    @classmethod
+    def create(cls, key, chunksize):
+        if not 0 < chunksize < 2 ** 32:
+            raise ValueError(_('chunksize must be between 1 and 2^32 - 1'))
+        return cls(key, chunksize, os.urandom(_STREAM_SALT_SIZE),
+                   os.urandom(_STREAM_PREFIX_SIZE))
+
+    @classmethod
+    def parse(cls, key, header, max_chunksize=STREAM_MAX_CHUNK_SIZE):
+        if (
+            len(header) != STREAM_HEADER_SIZE
+            or header[:len(STREAM_MAGIC)] != STREAM_MAGIC
+            or header[len(STREAM_MAGIC)] != STREAM_VERSION
+        ):
+            raise ValueError(_('Not an encrypted stream'))
+        offset = len(STREAM_MAGIC) + 1
+        chunksize = int.from_bytes(header[offset:offset + 4], 'big')
+        if not 0 < chunksize <= max_chunksize:
+            raise ValueError(_('Stream chunk size {} is not between 1 and {}').format(
+                chunksize, max_chunksize))
+        offset += 4
+        salt = header[offset:offset + _STREAM_SALT_SIZE]
+        prefix = header[offset + _STREAM_SALT_SIZE:]
+        return cls(key, chunksize, salt, prefix)
+
+    def nonce(self, index, final):
+        if index >= 2 ** 32:
+            raise ValueError(_('Stream is too long for its chunk size'))
+        return self.prefix + index.to_bytes(4, 'big') + (b'\x01' if final else b'\x00')
+
+    def encrypt_chunk(self, index, data, final):
+        return self.aead.encrypt(self.nonce(index, final), data, self.header)
+
+    def decrypt_chunk(self, index, data, final):
+        return self.aead.decrypt(self.nonce(index, final), data, self.header)
+
+
+def _read_exactly(fileobj, size):
+    """Read `size` bytes, fewer only at the end of the stream."""
+    data = fileobj.read(size)
+    while data and len(data) < size:
+        more = fileobj.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def _iter_stream_chunks(fileobj, size):
+    """Yield `(index, chunk, final)` for consecutive `size` byte chunks of a stream.
+
+    Reads one chunk ahead, to flag the final chunk. An empty stream has one empty chunk.
+    """
+    chunk = _read_exactly(fileobj, size)
+    index = 0
+    while True:
+        next_chunk = _read_exactly(fileobj, size) if len(chunk) == size else b''
+        yield index, chunk, not next_chunk
+        if not next_chunk:
+            return
+        chunk = next_chunk
+        index += 1
+
+
+def _map_ordered(func, items, workers):
+    """Yield `func(*item)` for each item, in order, computing up to `workers` at once.
+
+    At most two results per worker are pending at a time, so memory use stays bounded.
+    """
+    if not workers or workers <= 1:
+        for item in items:
+            yield func(*item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(func, *item))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def encrypt_stream(key, in_fileobj, chunksize=STREAM_CHUNK_SIZE, workers=None):
+    """ Encrypts a file object into chunks authenticated with AES-GCM.
+
+    Unlike `encrypt_fileobj`, each chunk is authenticated on its own, so `decrypt_stream` can
+    verify and release plaintext incrementally, and chunks can be decrypted independently.
+
+    Example::
+
+        with open('my_encrypted_file', mode='wb') as f:
+            for chunk in encrypt_stream(my_crypto_key, buffer):
+                f.write(chunk)
+
+    :param key: The encryption key - a string that must be
+        either 16, 24 or 32 bytes long.
+    :param in_fileobj: Readable IO stream holding plaintext contents.
+    :param chunksize: Size of plaintext in each chunk. Each chunk adds 16 bytes of
+        authentication tag to the output. Decrypting chunks larger than
+        `STREAM_MAX_CHUNK_SIZE` requires passing a larger `max_chunksize`.
+    :param workers: Number of threads encrypting chunks in parallel. Output is the same as
+        when encrypting serially.
+    :returns: Generator of encrypted data, starting with the header.
+    """
+    params = _StreamParams.create(key, chunksize)
+    yield params.header
+    yield from _map_ordered(
+        params.encrypt_chunk, _iter_stream_chunks(in_fileobj, chunksize), workers
+    )
+
+
+def decrypt_stream(key, in_fileobj, workers=None, max_chunksize=STREAM_MAX_CHUNK_SIZE):
+    """ Decrypts a file object written by `encrypt_stream`.
+
+    Each chunk is verified before it is yielded, so the plaintext can be released as it is
+    decrypted. Verification of the final chunk ensures the stream was not truncated.
+
+    :param key: The encryption key - a string that must be
+        either 16, 24 or 32 bytes long.
+    :param in_fileobj: Readable IO stream holding encrypted contents.
+    :param workers: Number of threads decrypting chunks in parallel.
+    :param max_chunksize: Largest chunk size accepted from the header. Streams encrypted with
+        a larger `chunksize` need a matching limit.
+    :returns: Generator of decrypted data.
+    :raises ValueError: if the stream does not start with a valid header.
+    :raises cryptography.exceptions.InvalidTag: if the key is wrong or the stream was
+        modified.
+    """
+    params = _StreamParams.parse(key, _read_exactly(in_fileobj, STREAM_HEADER_SIZE),
+                                 max_chunksize)
+
+    def segments():
+        for index, chunk, final in _iter_stream_chunks(in_fileobj, params.segment_size):
+            if len(chunk) < STREAM_TAG_SIZE:
+                raise InvalidTag()
+            yield index, chunk, final
+
+    yield from _map_ordered(params.decrypt_chunk, segments(), workers)
+
+
+def encrypt_stream_file(key, in_fpath, out_fpath=None, chunksize=STREAM_CHUNK_SIZE,
+                        workers=None):
+    """ Encrypts a file with `encrypt_stream`.
+
+    :param key: The encryption key - a string that must be
+        either 16, 24 or 32 bytes long.
+    :param in_fpath: Full path of the input file
+    :param out_fpath: Full path of the output file. If None, '<in_fpath>.enc' will be used.
+    :param chunksize: Size of plaintext in each chunk.
+    :param workers: Number of threads encrypting chunks in parallel. Larger chunk sizes
+        (e.g. 1MB) make the most of parallel encryption.
+    :returns: Output file path string.
+    """
+    if not out_fpath:
+        out_fpath = in_fpath + '.enc'
+
+    with open(in_fpath, 'rb') as infile, open(out_fpath, 'wb') as outfile:
+        for chunk in encrypt_stream(key, infile, chunksize, workers=workers):
+            outfile.write(chunk)
+
+    return out_fpath
+
+
+def decrypt_stream_file(key, in_fpath, out_fpath=None, workers=None,
+                        max_chunksize=STREAM_MAX_CHUNK_SIZE):
+    """ Decrypts a file written by `encrypt_stream_file`. Parameters are similar to
+        `decrypt_file`, but the default output file is in the input file's directory.
+    """
+    if out_fpath is None:
+        if Path(in_fpath).suffix == '.enc':
+            out_fpath = str(Path(in_fpath).with_suffix(''))
+        else:
+            raise ValueError(_('If input file name doesn\'t end in ".enc" then output '
+                               'filename must be given.'))
+    with open(in_fpath, 'rb') as infile, open(out_fpath, 'wb') as outfile:
+        for chunk in decrypt_stream(key, infile, workers=workers, max_chunksize=max_chunksize):
+            outfile.write(chunk)
+
+    return out_fpath
+
+
+class EncryptedStreamReader(io.RawIOBase):
+    """ Read-only, seekable file object over data written by `encrypt_stream`.
+
+    Chunks of the stream have a fixed size, so the chunk holding any plaintext offset can be
+    located directly, and only the chunks covering what is read are decrypted. The final
+    chunk is verified on creation, so `size` can be trusted and truncation is detected.
+
+    :param key: The encryption key - a string that must be
+        either 16, 24 or 32 bytes long.
+    :param fileobj: Readable and seekable IO stream holding encrypted contents.
+    :param close_fileobj: Close `fileobj` when this reader is closed.
+    :param max_chunksize: Largest chunk size accepted from the header.
+    :raises ValueError: if the stream does not start with a valid header.
+    :raises cryptography.exceptions.InvalidTag: if the key is wrong or the stream was
+        modified.
+    """
+
+    def __init__(self, key, fileobj, close_fileobj=False, max_chunksize=STREAM_MAX_CHUNK_SIZE):
+        super().__init__()
+        self._fileobj = fileobj
+        self._close_fileobj = close_fileobj
+        self._position = 0
+        self._cached_index = None
+        self._cached_chunk = None
+
+        fileobj.seek(0)
+        self._params = _StreamParams.parse(key, _read_exactly(fileobj, STREAM_HEADER_SIZE),
+                                           max_chunksize)
+        segment_size = self._params.segment_size
+
+        data_size = fileobj.seek(0, io.SEEK_END) - STREAM_HEADER_SIZE
+        self._chunk_count = max(1, -(-data_size // segment_size))
+        last_segment_size = data_size - (self._chunk_count - 1) * segment_size
+        if last_segment_size < STREAM_TAG_SIZE:
+            raise InvalidTag()
+        self.size = (
+            (self._chunk_count - 1) * self._params.chunksize
+            + last_segment_size - STREAM_TAG_SIZE
+        )
+        self._chunk(self._chunk_count - 1)
+
+    def _chunk(self, index):
+        if index != self._cached_index:
+            self._fileobj.seek(STREAM_HEADER_SIZE + index * self._params.segment_size)
+            segment = _read_exactly(self._fileobj, self._params.segment_size)
+            self._cached_chunk = self._params.decrypt_chunk(
+                index, segment, index == self._chunk_count - 1
+            )
+            self._cached_index = index
+        return self._cached_chunk
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(_('Invalid whence ({}), should be 0, 1 or 2').format(whence))
+        if position < 0:
+            raise ValueError(_('Negative seek position {}').format(position))
+        self._position = position
+        return position
+
+    def readinto(self, buffer):
+        self._checkClosed()
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self._position < self.size:
+            index, offset = divmod(self._position, self._params.chunksize)
+            chunk = self._chunk(index)
+            count = min(len(view) - filled, len(chunk) - offset)
+            view[filled:filled + count] = chunk[offset:offset + count]
+            filled += count
+            self._position += count
+        return filled
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        buffer = bytearray(min(size, max(self.size - self._position, 0)))
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def readall(self):
+        return self.read(max(self.size - self._position, 0))
+
+    def close(self):
+        if not self.closed and self._close_fileobj:
+            self._fileobj.close()
+        self._cached_chunk = None
+        super().close()
+
+
+def open_encrypted(fpath, key, max_chunksize=STREAM_MAX_CHUNK_SIZE):
+    """ Open a file written by `encrypt_stream_file` for reading, with random access.
+
+    Example::
+
+        with open_encrypted('report.pdf.enc', my_crypto_key) as f:
+            f.seek(1024)
+            data = f.read(4096)
+
+    :param fpath: Full path of the encrypted file
+    :param key: The encryption key - a string that must be
+        either 16, 24 or 32 bytes long.
+    :param max_chunksize: Largest chunk size accepted from the header.
+    :returns: `EncryptedStreamReader` for the file.
+    """
+    fileobj = open(fpath, 'rb')
+    try:
+        return EncryptedStreamReader(key, fileobj, close_fileobj=True,
+                                     max_chunksize=max_chunksize)
+    except Exception:
+        fileobj.close()
+        raise
+
+
+async def _read_async(reader, size):
+    data = reader.read(size)
+    if inspect.isawaitable(data):
+        data = await data
+    return data
+
+
+async def _write_async(writer, data):
+    result = writer.write(data)
+    if inspect.isawaitable(result):
+        await result
+    # asyncio.StreamWriter buffers writes until drained, which is where it applies backpressure
+    drain = getattr(writer, 'drain', None)
+    if drain is not None:
+        await drain()
+
+
+async def _pipe_async(reader, writer, chunksize, process, executor):
+    """Read chunks, process them in the executor, and write the results, in order.
+
+    The next chunk is read while the current one is processed. With at most two chunks in
+    memory at a time, a slow writer slows reading down rather than filling memory.
+    """
+    loop = asyncio.get_running_loop()
+    data = await _read_async(reader, chunksize)
+    while data:
+        processing = loop.run_in_executor(executor, process, data)
+        try:
+            data = await _read_async(reader, chunksize)
+        finally:
+            processed = await processing
+        await _write_async(writer, processed)
+
+
+class _ExecutorFile:
+    """Async reads and writes for a regular file object, run in an executor."""
+
+    def __init__(self, fileobj, executor):
+        self.fileobj = fileobj
+        self.executor = executor
+
+    async def read(self, size):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.fileobj.read, size)
+
+    async def write(self, data):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.fileobj.write, data)
+
+
+async def encrypt_fileobj_async(key, reader, writer, chunksize=64 * 1024, executor=None):
+    """ Encrypts from an async reader to an async writer using AES (CBC mode) with the given
+    key, producing the same format as `encrypt_fileobj`.
+
+    Readers need a `read(size)` method and writers a `write(data)` method, which may be
+    coroutines (e.g. aiofiles) or not. A writer's `drain()` method (e.g.
+    `asyncio.StreamWriter`) is awaited after each write.
+
+    :param key: The encryption key - a string that must be
+        either 16, 24 or 32 bytes long. Longer keys
+        are more secure.
+    :param reader: Async readable stream holding plaintext contents.
+    :param writer: Async writeable stream for encrypted contents.
+    :param chunksize: Sets the size of the chunk which the function uses to read and encrypt
+        the file.
+    :param executor: Executor that runs the encryption, so it doesn't block the event loop.
+        Defaults to the loop's default executor, which has a bounded number of threads.
+    :returns: None.
+    """
+    encryptor, iv = aes_encryptor(key)
+    padder = padding.PKCS7(ciphers.algorithms.AES.block_size).padder()
+
+    await _write_async(writer, iv)
+    await _pipe_async(
+        reader, writer, chunksize,
+        lambda data: encryptor.update(padder.update(data)),
+        executor,
+    )
+    await _write_async(writer, encryptor.update(padder.finalize()) + encryptor.finalize())
+
+
+async def decrypt_fileobj_async(key, reader, writer, chunksize=24 * 1024, executor=None):
+    """ Decrypts from an async reader to an async writer using AES (CBC mode) with the given
+    key. Parameters are the same as `encrypt_fileobj_async`.
+    """
+    iv = b''
+    while len(iv) < 16:
+        data = await _read_async(reader, 16 - len(iv))
+        if not data:
+            raise ValueError(_('Encrypted data is too short'))
+        iv += data
+
+    decryptor = aes_decryptor(key, iv)
+    unpadder = padding.PKCS7(ciphers.algorithms.AES.block_size).unpadder()
+
+    await _pipe_async(
+        reader, writer, chunksize,
+        lambda data: unpadder.update(decryptor.update(data)),
+        executor,
+    )
+    await _write_async(writer, unpadder.update(decryptor.finalize()) + unpadder.finalize())
+
+
+async def encrypt_file_async(key, in_fpath, out_fpath=None, chunksize=64 * 1024,
+                             executor=None):
+    """ Encrypts a file like `encrypt_file`, without blocking the event loop.
+
+    File access and encryption run in `executor` (the loop's default executor if not given).
+
+    :returns: Output file path string.
+    """
+    if not out_fpath:
+        out_fpath = in_fpath + '.enc'
+
+    loop = asyncio.get_running_loop()
+    infile = await loop.run_in_executor(executor, open, in_fpath, 'rb')
+    try:
+        outfile = await loop.run_in_executor(executor, open, out_fpath, 'wb')
+        try:
+            await encrypt_fileobj_async(
+                key, _ExecutorFile(infile, executor), _ExecutorFile(outfile, executor),
+                chunksize, executor=executor,
+            )
+        finally:
+            await loop.run_in_executor(executor, outfile.close)
+    finally:
+        await loop.run_in_executor(executor, infile.close)
+
+    return out_fpath
+
+
+async def decrypt_file_async(key, in_fpath, out_fpath=None, chunksize=24 * 1024,
+                             executor=None):
+    """ Decrypts a file like `decrypt_file`, without blocking the event loop.
+
+    File access and decryption run in `executor` (the loop's default executor if not given).
+
+    :returns: Output file path string.
+    """
+    if out_fpath is None:
+        if Path(in_fpath).suffix == '.enc':
+            out_fpath = Path(in_fpath).stem
+        else:
+            raise ValueError(_('If input file name doesn\'t end in ".enc" then output '
+                               'filename must be given.'))
+
+    loop = asyncio.get_running_loop()
+    infile = await loop.run_in_executor(executor, open, in_fpath, 'rb')
+    try:
+        outfile = await loop.run_in_executor(executor, open, out_fpath, 'wb')
+        try:
+            await decrypt_fileobj_async(
+                key, _ExecutorFile(infile, executor), _ExecutorFile(outfile, executor),
+                chunksize, executor=executor,
+            )
+        finally:
+            await loop.run_in_executor(executor, outfile.close)
+    finally:
+        await loop.run_in_executor(executor, infile.close)
+
+    return out_fpath
+
+
 def constant_time_compare(a, b):
     """Wrapper for cryptography constant time comparison, which will defeat timing attacks."""
     return constant_time.bytes_eq(a, b)
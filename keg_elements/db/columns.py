@@ -3,6 +3,7 @@ import enum
 import random
 
 import sqlalchemy as sa
+from keg.db import db
 
 from keg_elements import crypto
 from keg_elements.extensions import lazy_gettext as _
@@ -19,11 +20,16 @@ class EncryptedUnicode(sa.TypeDecorator):
     """
     Unicode column type that encrypts value with the given key for persistance to storage.
 
-    :param key: A bytes object containing the encryption key or a callable that returns the key
+    :param key: A bytes object containing the encryption key or a callable that returns the key.
+        The key may also be a list of keys, primary key first: values are encrypted with the
+        primary key and decrypted with any of them (see `crypto.fernet_cipher`). Custom
+        `encrypt`/`decrypt` callables receive the list in that case.
     :param encrypt: A callable that takes a unicode string and the encryption key as arguments
         and returns the encrypted data as a bytes object.
     :param decrypt: A callable that takes a bytes object and the encryption key as arguments
         and returns the decrypted data as a unicode string.
+    :param cache_key: Resolve the key once and reuse it, until `invalidate_key` is called.
+        Defaults to True.
     """
     impl = sa.UnicodeText
 
@@ -31,24 +37,117 @@ class EncryptedUnicode(sa.TypeDecorator):
         self._key = kwargs.pop('key')
         self._encrypt = kwargs.pop('encrypt', crypto.encrypt_str)
         self._decrypt = kwargs.pop('decrypt', crypto.decrypt_str)
+        self._cache_key = kwargs.pop('cache_key', True)
+        # Shared with the copies SQLAlchemy makes of this type for each dialect, so that
+        # invalidating the key on the column's type reaches them
+        self._key_cache = {}
         super(EncryptedUnicode, self).__init__(*args, **kwargs)
 
+    @property
+    def keys(self):
+        """All configured keys, primary key first."""
+        keys = self._key_cache.get('keys')
+        if keys is None:
+            key_val = self._key() if callable(self._key) else self._key
+            if not isinstance(key_val, (list, tuple)):
+                key_val = [key_val]
+            if not key_val:
+                raise ValueError(_('At least one key is required'))
+            if any(len(item) < 32 for item in key_val):
+                raise ValueError(_('Key must be at least 32 bytes long'))
+            keys = tuple(item[:32] for item in key_val)
+            if self._cache_key:
+                self._key_cache['keys'] = keys
+        return keys
+
     @property
     def key(self):
-        key_val = self._key() if callable(self._key) else self._key
-        if len(key_val) < 32:
-            raise ValueError(_('Key must be at least 32 bytes long'))
-        return key_val[:32]
+        return self.keys[0]
+
+    def invalidate_key(self):
+        """Drop the cached key, so it is resolved again on next use."""
+        self._key_cache.clear()
+
+    def _key_material(self):
+        keys = self.keys
+        return keys[0] if len(keys) == 1 else list(keys)
 
     def process_bind_param(self, value, dialect):
         if value is None:
             return None
-        return self._encrypt(value, self.key).decode()
+        return self._encrypt(value, self._key_material()).decode()
 
     def process_result_value(self, value, dialect):
         if value is None:
             return None
-        return self._decrypt(value.encode(), self.key)
+        return self._decrypt(value.encode(), self._key_material())
+
+    @staticmethod
+    def rotate(entity, column, batch_size=1000):
+        """Re-encrypt all values of an encrypted column with the current primary key.
+
+        Rows are read and updated in batches by primary key, and each batch is committed. The
+        column's cached key is invalidated first so that newly configured keys are used.
+
+        :param entity: The entity class the column belongs to
+        :param column: The column's attribute name, or the attribute itself
+        :param batch_size: Number of rows to re-encrypt per batch
+        :return: Number of rows re-encrypted
+        """
+        mapper = sa.inspect(entity)
+        column = mapper.columns[column if isinstance(column, str) else column.key]
+        column_type = column.type
+        column_type.invalidate_key()
+        dialect = db.session.get_bind().dialect
+
+        # Work on the stored ciphertext through a plain text column, which also keeps this
+        # type out of the statements' cache keys
+        table = sa.table(
+            column.table.name,
+            *[sa.column(pk.name, pk.type) for pk in mapper.primary_key],
+            sa.column(column.name, sa.UnicodeText),
+            schema=column.table.schema
+        )
+        primary_keys = [table.c[pk.name] for pk in mapper.primary_key]
+        raw_value = table.c[column.name]
+        update = table.update().where(
+            *[pk == sa.bindparam(f'pk_{index}') for index, pk in enumerate(primary_keys)]
+        ).values({column.name: sa.bindparam('v_value', type_=sa.UnicodeText)})
+
+        count = 0
+        last = None
+        while True:
+            query = sa.select(*primary_keys, raw_value).where(raw_value.isnot(None)) \
+                .order_by(*primary_keys).limit(batch_size)
+            if last is not None:
+                query = query.where(sa.or_(*[
+                    sa.and_(
+                        *[pk == value for pk, value in zip(primary_keys[:index], last)],
+                        primary_keys[index] > last[index]
+                    )
+                    for index in range(len(primary_keys))
+                ]))
+            rows = db.session.execute(query).all()
+            if not rows:
+                break
+
+            db.session.execute(update, [
+                {
+                    **{f'pk_{index}': value for index, value in enumerate(row[:-1])},
+                    'v_value': column_type.process_bind_param(
+                        column_type.process_result_value(row[-1], dialect), dialect
+                    ),
+                }
+                for row in rows
+            ])
+            db.session.commit()
+
+            count += len(rows)
+            last = tuple(rows[-1][:-1])
+            if len(rows) < batch_size:
+                break
+
+        return count
 
 
 class DBEnum(enum.Enum):
@@ -1,10 +1,14 @@
+import contextlib
 import copy
+import math
+import time
 
 import sqlalchemy as sa
 
 
 def add_non_nullable_column(op, table_name, column, default_value=None, default_value_query=None,
-                            schema=None):
+                            schema=None, batch_size=None, pk_column='id', batch_sleep=None,
+                            autocommit=False, progress=None):
     """
     Create a new non-nullable column
 
@@ -16,6 +20,13 @@ def add_non_nullable_column(op, table_name, column, default_value=None, default_
     :param default_value_query: An update query that sets the column value for all rows.
         Cannot be used with `default_value`
     :param schema: The name of the table's schema
+    :param batch_size: When given, backfill the column in batches of primary key ranges with
+        `backfill_column` instead of a single update. Requires an online migration.
+    :param pk_column: Name of the table's integer primary key, used for batching
+    :param batch_sleep: Seconds to sleep between batches
+    :param autocommit: Run the batches in an `autocommit_block` so that each batch is committed
+        on its own. Note that this commits the migration's transaction before the batches run.
+    :param progress: Callable receiving `(batch_number, batch_count)` after each batch
     :return:
     """
     if default_value is None and default_value_query is None:
@@ -28,7 +39,21 @@ def add_non_nullable_column(op, table_name, column, default_value=None, default_
 
     op.add_column(table_name, column, schema=schema)
 
-    if default_value_query is not None:
+    if batch_size is not None:
+        backfill_column(
+            op,
+            table_name,
+            column,
+            value=default_value,
+            query=default_value_query,
+            batch_size=batch_size,
+            pk_column=pk_column,
+            schema=schema,
+            sleep=batch_sleep,
+            autocommit=autocommit,
+            progress=progress,
+        )
+    elif default_value_query is not None:
         op.execute(default_value_query)
     else:
         op.execute(
@@ -49,6 +74,180 @@ def add_non_nullable_column(op, table_name, column, default_value=None, default_
     )
 
 
+def backfill_column(op, table_name, column, value=None, query=None, batch_size=1000,
+                    pk_column='id', schema=None, sleep=None, autocommit=False, progress=None):
+    """
+    Set a column's value for all rows in batches of primary key ranges, so that large tables
+    are not locked by a single long running update.
+
+    :param op: The operational module imported from alembic.op
+    :param table_name: The name of the table to update
+    :param column: An SQLAlchemy column declaration (i.e. `sa.Column()` expression)
+    :param value: The value to set the column to. Cannot be used with `query`
+    :param query: An update query that sets the column value. Each batch adds its primary key
+        range to the query's WHERE clause. Cannot be used with `value`
+    :param batch_size: The number of rows in each primary key range. Ranges are bounded by
+        the keys that exist, so gaps in the keys don't add empty batches
+    :param pk_column: Name of the table's integer primary key
+    :param schema: The name of the table's schema
+    :param sleep: Seconds to sleep between batches, to throttle load on the database
+    :param autocommit: Run the batches in an `autocommit_block` so that each batch is committed
+        on its own. Note that this commits the migration's transaction before the batches run.
+    :param progress: Callable receiving `(batch_number, batch_count)` after each batch. The
+        batch count is estimated from the number of rows when the backfill starts
+    """
+    if (value is None) == (query is None):
+        raise ValueError('Must provide exactly one of value or query')
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+
+    context = op.get_context()
+    if context.as_sql:
+        raise ValueError('Batched backfills read primary key ranges and require an online '
+                         'migration')
+
+    table = sa.Table(
+        table_name,
+        sa.MetaData(),
+        sa.Column(pk_column, sa.Integer, primary_key=True),
+        sa.Column(column.name, column.type),
+        schema=schema
+    )
+    pk = table.c[pk_column]
+    if query is None:
+        query = table.update().values({column.name: value})
+
+    bind = op.get_bind()
+    min_pk, max_pk, row_count = bind.execute(
+        sa.select(sa.func.min(pk), sa.func.max(pk), sa.func.count(pk))
+    ).one()
+    if min_pk is None:
+        return
+    batch_count = math.ceil(row_count / batch_size)
+
+    block = context.autocommit_block() if autocommit else contextlib.nullcontext()
+    with block:
+        lower = min_pk
+        batch_number = 0
+        while lower is not None:
+            # the key batch_size rows on is the next range's lower bound
+            upper = bind.execute(
+                sa.select(pk).where(pk >= lower, pk <= max_pk).order_by(pk)
+                .offset(batch_size).limit(1)
+            ).scalar()
+            range_pk = sa.column(pk_column)
+            op.execute(query.where(
+                range_pk >= lower, range_pk < upper if upper is not None else range_pk <= max_pk
+            ))
+
+            batch_number += 1
+            if progress is not None:
+                progress(batch_number, max(batch_count, batch_number))
+            if sleep and upper is not None:
+                time.sleep(sleep)
+            lower = upper
+
+
+def create_index_concurrently(op, index_name, table_name, columns, schema=None, unique=False,
+                              mssql_online=True, **kw):
+    """
+    Create an index without blocking writes to the table, if it does not exist yet.
+
+    On Postgres the index is built with `CREATE INDEX CONCURRENTLY`, which cannot run in a
+    transaction, so it runs in an `autocommit_block`. Note that this commits the migration's
+    transaction. An invalid index left over by a failed concurrent build is dropped and built
+    again, and the new index is checked to be valid.
+
+    On MSSQL the index is built `WITH (ONLINE = ON)` unless `mssql_online` is False (online
+    builds are not available in every edition). Other dialects create the index normally.
+
+    :param op: The operational module imported from alembic.op
+    :param index_name: The name of the index
+    :param table_name: The name of the table to index
+    :param columns: A list of column names or SQL expressions
+    :param schema: The name of the table's schema
+    :param unique: Create a unique index
+    :param kw: Additional dialect specific keyword arguments for `op.create_index`
+    """
+    context = op.get_context()
+    dialect_name = context.dialect.name
+
+    if dialect_name == 'postgresql':
+        with context.autocommit_block():
+            if not context.as_sql and _postgres_index_valid(op, index_name, schema) is False:
+                op.drop_index(index_name, schema=schema, postgresql_concurrently=True,
+                              if_exists=True)
+
+            op.create_index(index_name, table_name, columns, schema=schema, unique=unique,
+                            postgresql_concurrently=True, if_not_exists=True, **kw)
+
+            if not context.as_sql and not _postgres_index_valid(op, index_name, schema):
+                raise RuntimeError(f'Index {index_name} was not built successfully')
+
+    elif dialect_name == 'mssql':
+        table = sa.Table(
+            table_name,
+            sa.MetaData(),
+            *[sa.Column(column) for column in columns if isinstance(column, str)],
+            schema=schema
+        )
+        index = sa.Index(
+            index_name,
+            *[table.c[column] if isinstance(column, str) else column for column in columns],
+            unique=unique,
+            **kw
+        )
+        create = str(sa.schema.CreateIndex(index).compile(dialect=context.dialect)).strip()
+        if mssql_online:
+            create += ' WITH (ONLINE = ON)'
+
+        qualified_table = f'{schema}.{table_name}' if schema else table_name
+        op.execute(
+            f"IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = '{index_name}' "
+            f"AND object_id = OBJECT_ID('{qualified_table}')) {create}"
+        )
+
+    else:
+        op.create_index(index_name, table_name, columns, schema=schema, unique=unique,
+                        if_not_exists=True, **kw)
+
+
+def drop_index_concurrently(op, index_name, table_name=None, schema=None, **kw):
+    """
+    Drop an index without blocking access to the table, if it exists.
+
+    On Postgres the index is dropped with `DROP INDEX CONCURRENTLY` in an `autocommit_block`.
+    Note that this commits the migration's transaction. Other dialects drop the index normally.
+
+    :param op: The operational module imported from alembic.op
+    :param index_name: The name of the index
+    :param table_name: The name of the indexed table, required on MSSQL
+    :param schema: The name of the table's schema
+    :param kw: Additional dialect specific keyword arguments for `op.drop_index`
+    """
+    context = op.get_context()
+
+    if context.dialect.name == 'postgresql':
+        with context.autocommit_block():
+            op.drop_index(index_name, table_name=table_name, schema=schema,
+                          postgresql_concurrently=True, if_exists=True, **kw)
+    else:
+        op.drop_index(index_name, table_name=table_name, schema=schema, if_exists=True, **kw)
+
+
+def _postgres_index_valid(op, index_name, schema):
+    """Return whether the index is valid, or None when it does not exist."""
+    return op.get_bind().execute(
+        sa.text(
+            'SELECT i.indisvalid FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'JOIN pg_namespace n ON n.oid = c.relnamespace '
+            'WHERE c.relname = :index_name AND n.nspname = :schema'
+        ),
+        {'index_name': index_name, 'schema': schema or 'public'}
+    ).scalar()
+
+
 def postgres_update_enum_options(op, table_column_list, enum_name, new_values):
     """
     Update an enum's options within the migration transaction. In Postgres updating an enum is
@@ -89,6 +288,133 @@ def postgres_update_enum_options(op, table_column_list, enum_name, new_values):
         )
 
 
+def postgres_update_enum_options_online(op, table_column_list, enum_name, new_values,
+                                        old_values=None, schema=None, dry_run=False,
+                                        autocommit=False):
+    """
+    Update an enum's options while keeping table locks and rewrites to a minimum.
+
+    When values are only added (and existing values keep their order), they are added in place
+    with `ALTER TYPE ... ADD VALUE`, which does not touch any table. Otherwise a new type is
+    created, each column is converted to it with a single rewrite, and the new type is renamed
+    to replace the old one. Converting fails if a row holds a value that was removed.
+
+    Note: when the type is recreated, the default value is removed on every column updated so
+    you will need to reset any server-side defaults after running this function.
+
+    :param op: The operational module imported from alembic.op
+    :param table_column_list: A list of three item tuples (schema, table_name, column_name) for
+        each column where this enum is used
+    :param enum_name: The name of the enum type
+    :param new_values: A list of the enum's updated values
+    :param old_values: A list of the enum's current values. Read from the database when not
+        given, which requires an online migration.
+    :param schema: The schema of the enum type
+    :param dry_run: Do not change anything, only return the plan with `estimated_rows`, the
+        planner's estimate (`pg_class.reltuples`) of rows rewritten per table.
+    :param autocommit: Run `ADD VALUE` statements in an `autocommit_block`. Before Postgres 12
+        they cannot run in a transaction, and later versions do not allow using added values
+        until the transaction commits. Note that this commits the migration's transaction.
+    :return: A dict describing the plan, with `strategy` ("none", "add_value" or "recreate"),
+        `added` and `removed` values and, for a dry run, `estimated_rows`.
+    """
+    context = op.get_context()
+    if old_values is None:
+        if context.as_sql:
+            raise ValueError('old_values is required for offline migrations')
+        old_values = postgres_get_enum_values(op, enum_name, schema=schema)
+
+    old_values = list(old_values)
+    new_values = list(new_values)
+    added = [value for value in new_values if value not in old_values]
+    removed = [value for value in old_values if value not in new_values]
+
+    if old_values == new_values:
+        strategy = 'none'
+    elif not removed and [value for value in new_values if value in old_values] == old_values:
+        strategy = 'add_value'
+    else:
+        strategy = 'recreate'
+
+    plan = {'strategy': strategy, 'added': added, 'removed': removed}
+
+    if dry_run:
+        if context.as_sql:
+            raise ValueError('dry_run requires an online migration')
+        plan['estimated_rows'] = {
+            (table_schema, table_name): (
+                _postgres_estimated_rows(op, table_schema, table_name)
+                if strategy == 'recreate' else 0
+            )
+            for table_schema, table_name, _ in table_column_list
+        }
+        return plan
+
+    preparer = context.dialect.identifier_preparer
+    type_name = preparer.quote(enum_name)
+    if schema:
+        type_name = f'{preparer.quote_schema(schema)}.{type_name}'
+
+    def literal(value):
+        return "'{}'".format(value.replace("'", "''"))
+
+    if strategy == 'add_value':
+        block = context.autocommit_block() if autocommit else contextlib.nullcontext()
+        with block:
+            for index, value in enumerate(new_values):
+                if value not in added:
+                    continue
+                if index > 0:
+                    position = f' AFTER {literal(new_values[index - 1])}'
+                elif old_values:
+                    position = f' BEFORE {literal(old_values[0])}'
+                else:
+                    position = ''
+                op.execute(f'ALTER TYPE {type_name} ADD VALUE IF NOT EXISTS {literal(value)}'
+                           f'{position}')
+
+    elif strategy == 'recreate':
+        temp_name = f'{enum_name}_new'
+        temp_type_name = preparer.quote(temp_name)
+        if schema:
+            temp_type_name = f'{preparer.quote_schema(schema)}.{temp_type_name}'
+        new_type = sa.Enum(*new_values, name=temp_name, schema=schema)
+        new_type.create(op.get_bind(), checkfirst=False)
+
+        for table_schema, table_name, column_name in table_column_list:
+            op.alter_column(
+                table_name,
+                column_name,
+                schema=table_schema,
+                server_default=None
+            )
+            op.alter_column(
+                table_name,
+                column_name,
+                schema=table_schema,
+                type_=new_type,
+                postgresql_using=f'{column_name}::text::{temp_type_name}'
+            )
+
+        op.execute(f'DROP TYPE {type_name}')
+        op.execute(f'ALTER TYPE {temp_type_name} RENAME TO {preparer.quote(enum_name)}')
+
+    return plan
+
+
+def _postgres_estimated_rows(op, schema, table_name):
+    result = op.get_bind().execute(
+        sa.text(
+            'SELECT c.reltuples FROM pg_class c '
+            'JOIN pg_namespace n ON n.oid = c.relnamespace '
+            'WHERE c.relname = :table_name AND n.nspname = :schema'
+        ),
+        {'table_name': table_name, 'schema': schema or 'public'}
+    ).scalar()
+    # reltuples is -1 for tables that were never analyzed
+    return max(int(result or 0), 0)
+
+
 def postgres_get_enum_values(op, enum_name, schema=None):
     """
     Get a list of values for an existing enum type.
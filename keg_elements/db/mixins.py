@@ -1,6 +1,10 @@
 import datetime as dt
+import functools
+import itertools
 import operator
 import random
+import threading
+import time
 
 import arrow
 import blazeutils.strings
@@ -9,7 +13,9 @@ import sqlalchemy as sa
 import wrapt
 from blazeutils import tolist
 from keg.db import db
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.sql import operators
 from sqlalchemy_utils import ArrowType, EmailType
 
 import keg_elements.db.columns as columns
@@ -35,6 +41,194 @@ Exceptions during flush are raised after the session is rolled back.
 """
 
 
+class EntityMetadata:
+    """Column and relationship details of a mapped entity class.
+
+    Inspecting the mapper is relatively expensive, so use ``EntityMetadata.get(entity_cls)``,
+    which computes the details once per class. The cache is invalidated whenever mappers are
+    configured, since a newly configured mapper may add backrefs to existing entities.
+    """
+    _cache = {}
+
+    def __init__(self, entity_cls):
+        mapper = sa.inspect(entity_cls)
+
+        #: all mapper properties by key
+        self.props = {prop.key: prop for prop in mapper.attrs}
+        #: column property keys, including column_property expressions
+        self.column_prop_keys = frozenset(
+            key for key, prop in self.props.items()
+            if isinstance(prop, sa.orm.properties.ColumnProperty)
+        )
+        #: relationship properties by key
+        self.relationships = dict(mapper.relationships.items())
+        #: mapped columns, in mapper order
+        self.columns = tuple(mapper.columns)
+        #: keys of mapped columns, which may not match attribute names
+        self.column_keys = frozenset(col.key for col in self.columns)
+        #: keys allowed as kwargs for entity methods
+        self.kwarg_keys = self.column_keys | frozenset(self.relationships)
+        #: the table's primary key columns
+        self.primary_keys = entity_cls.__table__.primary_key.columns
+        #: compiled serializers, keyed by field spec
+        self.serializers = {}
+
+    @classmethod
+    def get(cls, entity_cls):
+        """Fetch cached metadata for an entity class, computing it if needed."""
+        try:
+            return cls._cache[entity_cls]
+        except KeyError:
+            metadata = cls._cache[entity_cls] = cls(entity_cls)
+            return metadata
+
+    @classmethod
+    def invalidate(cls, entity_cls=None):
+        """Remove cached metadata for the given entity class, or all classes if not given."""
+        if entity_cls is None:
+            cls._cache.clear()
+        else:
+            cls._cache.pop(entity_cls, None)
+
+
+def _freeze_spec(value):
+    """Make a (possibly nested) serializer field spec hashable for caching."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze_spec(val)) for key, val in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze_spec(val) for val in value)
+    return value
+
+
+class EntitySerializer:
+    """Serialize entity instances to dicts with a field pipeline compiled up front.
+
+    Build with ``MethodsMixin.serializer``, which caches serializers per entity and field spec.
+
+    :param entity_cls: mapped entity class to serialize.
+    :param include: iterable of attribute names to include. Defaults to all columns. Hybrid
+        properties and other attributes may also be named.
+    :param exclude: iterable of attribute names to leave out.
+    :param nested: dict of relationship name to serialize, mapped to a dict of ``include``,
+        ``exclude`` and ``nested`` arguments for the related entity (or None for defaults).
+    :param load: iterable of column attribute names that attributes in ``include`` other
+        than columns depend on. When given, queries load only the included columns and these.
+        When not given and such attributes are included, all columns are loaded.
+    """
+
+    def __init__(self, entity_cls, include=None, exclude=(), nested=None, load=None):
+        metadata = EntityMetadata.get(entity_cls)
+        self.entity_cls = entity_cls
+
+        if include is None:
+            include = [col.key for col in metadata.columns]
+        self.fields = tuple(name for name in include if name not in exclude)
+        unknown = [name for name in self.fields if not hasattr(entity_cls, name)]
+        if unknown:
+            raise ValueError(_('Unknown attribute names for serializer: {names!r}',
+                               names=unknown))
+
+        if len(self.fields) == 1:
+            getter = operator.attrgetter(self.fields[0])
+            self._getter = lambda obj: (getter(obj),)
+        elif self.fields:
+            self._getter = operator.attrgetter(*self.fields)
+        else:
+            self._getter = lambda obj: ()
+
+        self.nested = {}
+        self._uselist = {}
+        load_keys = [name for name in self.fields if name in metadata.column_prop_keys]
+        if load is not None:
+            unknown = [name for name in load if name not in metadata.column_prop_keys]
+            if unknown:
+                raise ValueError(_('Unknown column names for serializer load: {names!r}',
+                                   names=unknown))
+            load_keys.extend(load)
+        elif len(load_keys) < len(self.fields):
+            # properties may use any column, deferring columns would lazy load them per record
+            load_keys = []
+        self._load_all = not load_keys
+        for name, spec in (nested or {}).items():
+            if name not in metadata.relationships:
+                raise ValueError(_('Unknown relationship name for serializer: {name!r}',
+                                   name=name))
+            prop = metadata.relationships[name]
+            self.nested[name] = EntitySerializer.get(prop.mapper.class_, **(spec or {}))
+            self._uselist[name] = prop.uselist
+            # many-to-one loads need the local foreign key values, so don't defer them
+            load_keys.extend(
+                prop.parent.get_property_by_column(col).key for col in prop.local_columns
+            )
+        self._load_keys = () if self._load_all else tuple(dict.fromkeys(load_keys))
+
+    @classmethod
+    def get(cls, entity_cls, include=None, exclude=(), nested=None, load=None):
+        """Fetch a cached serializer for the entity class and field spec, building if needed."""
+        serializers = EntityMetadata.get(entity_cls).serializers
+        key = (_freeze_spec(include), frozenset(exclude), _freeze_spec(nested),
+               _freeze_spec(load))
+        try:
+            return serializers[key]
+        except KeyError:
+            serializer = serializers[key] = cls(entity_cls, include, exclude, nested, load)
+            return serializer
+
+    def __call__(self, obj):
+        """Serialize a single entity instance."""
+        data = dict(zip(self.fields, self._getter(obj)))
+        for name, serializer in self.nested.items():
+            value = getattr(obj, name)
+            if value is None:
+                data[name] = None
+            elif self._uselist[name]:
+                data[name] = serializer.many(value)
+            else:
+                data[name] = serializer(value)
+        return data
+
+    def many(self, objs):
+        """Serialize an iterable of entity instances to a list of dicts."""
+        return [self(obj) for obj in objs]
+
+    def options(self):
+        """Loader options that load only the serialized columns (see ``load``) and eager load
+        nested relationships with ``selectinload``, so serializing a list of records does not
+        lazy load per record."""
+        options = []
+        if self._load_keys:
+            options.append(sa.orm.load_only(
+                *(getattr(self.entity_cls, key) for key in self._load_keys)
+            ))
+        for name, serializer in self.nested.items():
+            loader = sa.orm.selectinload(getattr(self.entity_cls, name))
+            nested_options = serializer.options()
+            if nested_options:
+                loader = loader.options(*nested_options)
+            options.append(loader)
+        return options
+
+    def query(self, query=None):
+        """Apply this serializer's loader options to the query (entity query by default)."""
+        query = query if query is not None else self.entity_cls.query
+        return query.options(*self.options())
+
+    def all(self, query=None):
+        """Run the query with loader options applied and serialize all results."""
+        return self.many(self.query(query))
+
+
+@sa.event.listens_for(sa.orm.Mapper, 'mapper_configured')
+def _invalidate_entity_metadata(mapper, class_):
+    EntityMetadata.invalidate(class_)
+
+
+@sa.event.listens_for(sa.orm.Mapper, 'after_configured')
+def _invalidate_all_entity_metadata():
+    # backrefs from newly configured mappers may have been added to cached entities
+    EntityMetadata.invalidate()
+
+
 @wrapt.decorator
 def kwargs_match_entity(wrapped, instance, args, kwargs):
     """
@@ -42,10 +236,10 @@ def kwargs_match_entity(wrapped, instance, args, kwargs):
     of the entity.
     """
     if kwargs.get('_check_kwargs', True):
-        insp = sa.inspection.inspect(instance)
+        entity_cls = instance if isinstance(instance, type) else type(instance)
 
         # Only allow kwargs that correspond to a column or relationship on the entity
-        allowed_keys = {col.key for col in insp.columns} | set(insp.relationships.keys())
+        allowed_keys = EntityMetadata.get(entity_cls).kwarg_keys
 
         # Ignore kwargs starting with "_"
         kwarg_keys = set(key for key in kwargs if not key.startswith('_'))
@@ -64,6 +258,29 @@ class DefaultColsMixin(object):
                             server_default=dbutils.utcnow())
 
 
+class KeysetPage:
+    """A page of records from ``MethodsMixin.paginate_keyset``.
+
+    :ivar items: list of entity instances on the page.
+    :ivar next_cursor: opaque cursor to pass as ``after`` for the next page, or None if this
+        is the last page.
+    """
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
 class MethodsMixin:
     """Entity mixin providing developer/testing-centered methods."""
     def from_dict(self, data):
@@ -91,19 +308,16 @@ class MethodsMixin:
                 else:
                     setattr(self, key, related_class.add_or_edit(value, _commit=False))
 
-        mapper = self.__mapper__
-        entity_props = {attr.key: attr for attr in mapper.attrs}
+        metadata = EntityMetadata.get(type(self))
 
         for key, value in data.items():
-            prop = entity_props.get(key)
-            is_column = isinstance(prop, sa.orm.properties.ColumnProperty)
-            is_relationship = isinstance(prop, sa.orm.properties.RelationshipProperty)
+            prop = metadata.props.get(key)
 
             if prop is None:
                 continue
-            elif is_column:
+            elif key in metadata.column_prop_keys:
                 setattr(self, key, value)
-            elif is_relationship:
+            elif key in metadata.relationships:
                 update_related(key, value, prop)
             else:
                 raise NotImplementedError(
@@ -121,7 +335,7 @@ class MethodsMixin:
             included.
         """
         data = dict((name, getattr(self, name))
-                    for name in self.column_names()
+                    for name in EntityMetadata.get(type(self)).column_keys
                     if name not in exclude)
 
         for hybrid in hybrids:
@@ -129,15 +343,59 @@ class MethodsMixin:
 
         return data
 
+    @classmethod
+    def iter_dicts(cls, query=None, columns=None, chunk_size=1000, named_tuples=False):
+        """Iterate over records as plain dicts keyed like ``to_dict``, without hydrating ORM
+        instances. Useful for exports and other large result sets.
+
+        Only the needed columns are selected, and results are fetched from a server-side
+        cursor ``chunk_size`` rows at a time where the dialect supports it, so memory use
+        does not grow with the size of the result.
+
+        :param query: optional base query or select statement to take filters/ordering from.
+            Defaults to all records of the entity.
+        :param columns: iterable of column keys (or hybrid property names) to include.
+            Defaults to all columns.
+        :param chunk_size: number of rows to fetch from the cursor at a time.
+        :param named_tuples: yield named tuple rows instead of dicts.
+        """
+        if columns is None:
+            columns = [col.key for col in EntityMetadata.get(cls).columns]
+        columns = list(columns)
+        col_exprs = [getattr(cls, key).label(key) for key in columns]
+
+        if query is None:
+            stmt = sa.select(*col_exprs)
+        elif isinstance(query, sa.sql.Select):
+            stmt = query.with_only_columns(*col_exprs)
+        else:
+            stmt = query.with_entities(*col_exprs).statement
+
+        result = db.session.execute(stmt, execution_options={'yield_per': chunk_size})
+        for row in result:
+            yield row if named_tuples else dict(zip(columns, row))
+
+    @classmethod
+    def serializer(cls, include=None, exclude=(), nested=None, load=None):
+        """Get a compiled serializer for this entity. See ``EntitySerializer``.
+
+        Serializers are cached per entity and field spec, so this is cheap to call repeatedly::
+
+            serializer = Thing.serializer(exclude={'created_utc'}, nested={'related_things': None})
+            data = serializer.all(Thing.query.filter_by(color='blue'))
+        """
+        return EntitySerializer.get(cls, include=include, exclude=exclude, nested=nested,
+                                    load=load)
+
     @classmethod
     def column_names(cls):
         """Return a set of column keys, which may not match attribute names."""
-        return {col.key for col in cls.__mapper__.columns}
+        return set(EntityMetadata.get(cls).column_keys)
 
     @classmethod
     def primary_keys(cls):
         """Helper to get the table's primary key columns."""
-        return cls.__table__.primary_key.columns
+        return EntityMetadata.get(cls).primary_keys
 
     @might_commit
     @might_flush
@@ -240,6 +498,57 @@ class MethodsMixin:
             return result.fetchone()
         return result.scalar()
 
+    @classmethod
+    def insert_many(cls, rows, batch_size=1000):
+        """Bulk version of ``insert``. Rows are sent to the database in batches of
+        ``batch_size``, each batch as a single executemany/multi-row VALUES statement.
+
+        All rows should supply the same set of keys, since each batch is compiled from a single
+        INSERT statement.
+
+        Assumes the calling code is handling session flush/commit.
+
+        :param rows: iterable of dicts of values to insert
+        :param batch_size: maximum number of rows to send in a single statement
+        :return: list of primary key value(s) in the order of ``rows``. Rows are returned
+            for multiple primary key entities. Note: SQLite does not support this and
+            None is returned.
+        """
+        stmt = sa.insert(cls.__table__)
+        primary_keys = cls.primary_keys()
+        use_returning = db.engine.dialect.name != 'sqlite'
+        if use_returning:
+            stmt = stmt.returning(*primary_keys, sort_by_parameter_order=True)
+
+        retval = []
+        for batch in dbutils.chunked(rows, batch_size):
+            result = db.session.execute(stmt, batch)
+            if not use_returning:
+                continue
+            if len(primary_keys) > 1:
+                retval.extend(result.all())
+            else:
+                retval.extend(result.scalars().all())
+
+        return retval if use_returning else None
+
+    @might_commit
+    @might_flush
+    @classmethod
+    def add_many(cls, rows):
+        """Create many persisted records, each constructed from a dict in ``rows``.
+
+        Records are added to the session together so that the flush can batch the INSERTs.
+        Prefer ``insert_many`` when ORM instances are not needed.
+
+        :param rows: iterable of dicts, each passed as kwargs to ``add``.
+        :param _commit: enable/disable commit. Default True.
+        :param _flush: enable/disable flush. Default True.
+        :return: list of entity instances created and optionally persisted.
+        """
+        with db.session.no_autoflush:
+            return [cls.add(_commit=False, _flush=False, **row) for row in rows]
+
     @classmethod
     def update(cls, ent_id, values=None, **kwargs):
         """Similar to ``edit`` but without the ORM overhead. Useful for high data throughput
@@ -274,6 +583,150 @@ class MethodsMixin:
         )
         return db.session.execute(stmt)
 
+    @classmethod
+    def update_many(cls, rows, batch_size=1000):
+        """Bulk version of ``update``. Each dict in ``rows`` must contain the primary key
+        value(s) of the record to update, along with the values to set. Rows are sent to the
+        database in batches of ``batch_size``, each batch as a single executemany UPDATE.
+
+        All rows should supply the same set of keys, since each batch is compiled from a single
+        UPDATE statement.
+
+        Assumes the calling code is handling session flush/commit.
+
+        :param rows: iterable of dicts of primary key values and values to update
+        :param batch_size: maximum number of rows to send in a single statement
+        :return: list of db rowcounts, one for each batch. Note: some DBAPIs report -1 for
+            executemany statements
+        """
+        primary_keys = cls.primary_keys()
+        pk_keys = {col.key for col in primary_keys}
+
+        rowcounts = []
+        for batch in dbutils.chunked(rows, batch_size):
+            # bind names must not clash with the column names SA uses for the SET clause
+            value_keys = [key for key in batch[0] if key not in pk_keys]
+            stmt = (
+                sa.update(cls.__table__)
+                .values({key: sa.bindparam('v_' + key) for key in value_keys})
+                .where(*(col == sa.bindparam('pk_' + col.key) for col in primary_keys))
+            )
+            params = [
+                dict(
+                    {'pk_' + key: row[key] for key in pk_keys},
+                    **{'v_' + key: row[key] for key in value_keys}
+                )
+                for row in batch
+            ]
+            result = db.session.execute(stmt, params)
+            rowcounts.append(result.rowcount)
+
+        return rowcounts
+
+    @classmethod
+    def paginate_keyset(cls, order_by=(), after=None, limit=50, query=None):
+        """Fetch a page of records using keyset (seek) pagination.
+
+        Rather than an OFFSET, which the database must scan past, each page is selected with
+        a WHERE condition on the sort key values of the previous page's last record, so deep
+        pages are as fast as the first when the sort columns are indexed.
+
+        Primary key columns are added to the sort as a tiebreaker, so the order is always
+        unique. Sort columns should not be nullable.
+
+        :param order_by: iterable of columns to sort by, optionally with ``.desc()``. Column
+            attribute names of the entity may be given for ascending sorts.
+        :param after: cursor from a previous page's ``next_cursor``. None for the first page.
+        :param limit: maximum number of records on the page.
+        :param query: optional base query to take filters from.
+        :return: ``KeysetPage``. Raises ValueError if the cursor is not valid for the sort.
+        """
+        sort_keys = []
+        for item in tolist(order_by):
+            if isinstance(item, str):
+                if item not in EntityMetadata.get(cls).column_prop_keys:
+                    raise ValueError(_('Unknown column name for sort: {name!r}', name=item))
+                item = getattr(cls, item)
+            if hasattr(item, '__clause_element__'):
+                item = item.__clause_element__()
+            descending = False
+            if isinstance(item, sa.sql.elements.UnaryExpression) \
+                    and item.modifier in (operators.asc_op, operators.desc_op):
+                descending = item.modifier is operators.desc_op
+                item = item.element
+            sort_keys.append((item, descending))
+        for pk_column in cls.primary_keys():
+            if not any(column.compare(pk_column) for column, _ in sort_keys):
+                sort_keys.append((pk_column, False))
+
+        columns = [column for column, _ in sort_keys]
+        query = query if query is not None else cls.query
+        query = query.add_columns(*columns).order_by(None).order_by(
+            *(column.desc() if descending else column.asc() for column, descending in sort_keys)
+        )
+
+        if after is not None:
+            values = dbutils.decode_cursor(after)
+            if len(values) != len(sort_keys):
+                raise ValueError(_('Invalid cursor'))
+
+            # (a, b) > (x, y) expanded as a > x OR (a = x AND b > y), which supports mixed
+            # sort directions
+            conditions = []
+            for idx, ((column, descending), value) in enumerate(zip(sort_keys, values)):
+                equal_prior = [prior == prior_value for (prior, _), prior_value
+                               in zip(sort_keys[:idx], values[:idx])]
+                seek = column < value if descending else column > value
+                conditions.append(sa.and_(*equal_prior, seek))
+            query = query.filter(sa.or_(*conditions))
+
+        rows = query.limit(limit + 1).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = dbutils.encode_cursor(rows[-1][1:])
+
+        return KeysetPage([row[0] for row in rows], next_cursor)
+
+    @classmethod
+    def iter_chunks(cls, query=None, chunk_size=1000, by='pk', expunge=True):
+        """Iterate over records in lists of up to ``chunk_size``, keeping memory use constant
+        for scans of large tables, e.g. in data migrations.
+
+        :param query: optional base query to take filters from.
+        :param chunk_size: maximum number of records in each chunk.
+        :param by: ``'pk'`` runs a query per chunk, seeking by primary key ranges (see
+            ``paginate_keyset``), so no cursor is held open between chunks. ``'stream'`` runs
+            one query, fetching chunks from a server-side cursor where the dialect supports it.
+            Order of the base query is kept when streaming.
+        :param expunge: after each chunk is processed, flush the session and expunge the
+            chunk's records, so they are not held in the identity map.
+        """
+        if by == 'pk':
+            def chunks():
+                cursor = None
+                while True:
+                    page = cls.paginate_keyset(after=cursor, limit=chunk_size, query=query)
+                    if page.items:
+                        yield page.items
+                    if not page.has_next:
+                        return
+                    cursor = page.next_cursor
+        elif by == 'stream':
+            def chunks():
+                stmt = (query if query is not None else cls.query).statement
+                result = db.session.execute(stmt, execution_options={'yield_per': chunk_size})
+                yield from result.scalars().partitions()
+        else:
+            raise ValueError(_('by must be "pk" or "stream"'))
+
+        for chunk in chunks():
+            yield chunk
+            if expunge:
+                db.session.flush()
+                for obj in chunk:
+                    db.session.expunge(obj)
+
     @classmethod
     def get(cls, ident, **kwargs):
         """Wraps db.session.get"""
@@ -349,14 +802,12 @@ class MethodsMixin:
 
         numeric_range = kwargs.pop('_numeric_defaults_range', None)
 
-        insp = sa.inspection.inspect(cls)
-
         skippable = lambda column: (
             column.key in kwargs                # skip fields already in kwargs
             or cls.testing_skip_column(column)  # skip fields defined by class rules
         )
 
-        for column in (col for col in insp.columns if not skippable(col)):
+        for column in (col for col in EntityMetadata.get(cls).columns if not skippable(col)):
             try:
                 kwargs[column.key] = cls.random_data_for_column(
                     column, numeric_range)
@@ -365,6 +816,90 @@ class MethodsMixin:
 
         return cls.add(**kwargs)
 
+    @might_commit
+    @classmethod
+    def fake_many(cls, n, _batch_size=1000, _seed=None, _parent_pool_size=10,
+                  _numeric_defaults_range=None, **kwargs):
+        """Bulk version of ``fake``, for seeding large data sets for load testing and
+        benchmarks. Records are written with ``insert_many``, so no ORM instances are created.
+
+        * Random data comes from ``random_data_for_column``, as with ``fake``. The columns to
+          generate are determined once, rather than per record.
+        * kwargs give column values to use for every record. A callable value is called for
+          each record instead.
+        * Required foreign key columns not given in kwargs are filled from a pool of
+          ``_parent_pool_size`` parent records, created with the parent entity's ``fake``.
+          Columns in multi-column foreign keys must be given in kwargs.
+
+        :param n: number of records to create.
+        :param _batch_size: maximum number of rows to send in a single INSERT.
+        :param _seed: seed for the random data, to create reproducible data sets. The state of
+            the ``random`` module is restored afterwards.
+        :param _parent_pool_size: number of parent records to create for each foreign key.
+        :param _numeric_defaults_range: as with ``fake``.
+        :param _commit: enable/disable commit. Default True.
+        :return: as with ``insert_many``.
+        """
+        metadata = EntityMetadata.get(cls)
+        extra_kwargs = set(kwargs) - metadata.column_keys
+        assert not extra_kwargs, _('Unknown column names in kwargs: {kwargs!r}',
+                                   kwargs=sorted(extra_kwargs))
+
+        random_state = random.getstate()
+        if _seed is not None:
+            random.seed(_seed)
+        try:
+            generators = {
+                key: value if callable(value) else (lambda value=value: value)
+                for key, value in kwargs.items()
+            }
+            for column in metadata.columns:
+                if column.key in kwargs:
+                    continue
+                if column.foreign_keys and not column.nullable and not column.primary_key:
+                    pool = cls._fake_parent_pool(column, _parent_pool_size)
+                    generators[column.key] = lambda pool=pool: random.choice(pool)
+                    continue
+                if cls.testing_skip_column(column):
+                    continue
+                try:
+                    cls.random_data_for_column(column, _numeric_defaults_range)
+                except ValueError:
+                    continue
+                generators[column.key] = functools.partial(
+                    cls.random_data_for_column, column, _numeric_defaults_range
+                )
+
+            rows = (
+                {key: generator() for key, generator in generators.items()}
+                for _ in range(n)
+            )
+            return cls.insert_many(rows, batch_size=_batch_size)
+        finally:
+            if _seed is not None:
+                random.setstate(random_state)
+
+    @classmethod
+    def _fake_parent_pool(cls, column, pool_size):
+        """Create parent records for a foreign key column, returning the referenced values."""
+        fk = next(iter(column.foreign_keys))
+        if len(fk.constraint.columns) > 1:
+            raise ValueError(_('fake_many cannot generate values for {column} in a multi-column'
+                               ' foreign key, pass it as a kwarg', column=column.key))
+
+        parent_table = fk.column.table
+        for mapper in sa.inspect(cls).registry.mappers:
+            if mapper.local_table is parent_table and hasattr(mapper.class_, 'fake'):
+                parent_cls = mapper.class_
+                break
+        else:
+            raise ValueError(_('fake_many found no entity to create {table} records for {column}',
+                               table=parent_table.name, column=column.key))
+
+        # flushing is enough to get keys, committing would also commit the caller's pending work
+        return [getattr(parent_cls.fake(_commit=False, _flush=True), fk.column.key)
+                for _ in range(pool_size)]
+
     @classmethod
     def testing_skip_column(cls, column):
         is_property = lambda column: isinstance(column, sa.sql.elements.Label)
@@ -492,6 +1027,116 @@ class MethodsMixin:
                 if obj is None
                 else cls.edit(primary_keys, _commit=False, **data))
 
+    @classmethod
+    def upsert_many(cls, rows, conflict_columns=None, update_columns=None, batch_size=1000):
+        """Set-based version of ``add_or_edit``. Creates or updates a record for each dict in
+        ``rows`` without the ORM overhead of a lookup and flush per record.
+
+        Each batch issues one upsert statement: ``INSERT ... ON CONFLICT DO UPDATE`` on
+        PostgreSQL and SQLite, ``MERGE`` on MSSQL. Columns having an ``onupdate`` are refreshed
+        on updated records.
+
+        Rows repeating a conflict key within a batch are collapsed, the last row winning, as
+        a statement can't write the same record twice.
+
+        On PostgreSQL, whether each record was created or updated is taken from the upsert
+        itself (``RETURNING xmax = 0``). Other dialects issue a SELECT for existing records
+        before each upsert, so the statuses are best-effort when other transactions write
+        the same records concurrently. A key repeated in a later batch keeps the status of
+        its first write.
+
+        All rows should supply the same set of keys. Assumes the calling code is handling
+        session flush/commit.
+
+        :param rows: iterable of dicts of values to insert or update
+        :param conflict_columns: column key(s) identifying an existing record. Must be covered
+            by a primary key or unique constraint. Defaults to the primary key columns.
+        :param update_columns: column keys to update on existing records. Defaults to all
+            keys given in the rows other than the conflict columns.
+        :param batch_size: maximum number of rows to send in a single statement
+        :return: dict mapping each row's conflict column value(s) to ``'created'`` or
+            ``'updated'``. Keys are tuples when there are multiple conflict columns.
+        """
+        table = cls.__table__
+        dialect = db.engine.dialect
+        if dialect.name not in ('postgresql', 'sqlite', 'mssql'):
+            raise ValueError('upsert_many() does not yet support dialect: %s' % dialect.name)
+
+        if conflict_columns is None:
+            conflict_columns = [col.key for col in cls.primary_keys()]
+        conflict_columns = tolist(conflict_columns)
+        key_columns = [table.c[key] for key in conflict_columns]
+
+        if dialect.name == 'mssql':
+            # MSSQL allows at most 2100 parameters in a statement
+            batch_size = max(1, min(batch_size, 2000 // (len(table.columns) + 1)))
+
+        def row_key(row):
+            if len(conflict_columns) == 1:
+                return row[conflict_columns[0]]
+            return tuple(row[key] for key in conflict_columns)
+
+        def existing_keys(keys):
+            clause = dbutils.columns_in(key_columns, keys)
+            result = db.session.execute(sa.select(*key_columns).where(clause))
+            if len(key_columns) == 1:
+                return set(result.scalars())
+            return {tuple(row) for row in result}
+
+        statuses = {}
+        for batch in dbutils.chunked(rows, batch_size):
+            batch = list({row_key(row): row for row in batch}.values())
+            batch_update_columns = update_columns
+            if batch_update_columns is None:
+                batch_update_columns = [key for key in batch[0] if key not in conflict_columns]
+            update_values = {
+                col.key: dbutils.python_default_value(col.onupdate)
+                for col in table.columns
+                if col.onupdate is not None
+                and col.key not in batch_update_columns
+                and col.key not in conflict_columns
+            }
+            update_values = {key: value for key, value in update_values.items()
+                             if value is not None}
+
+            if dialect.name == 'postgresql':
+                # existing records are not returned when there is nothing to update
+                existing = {row_key(row) for row in batch}
+            else:
+                existing = existing_keys([row_key(row) for row in batch])
+
+            if dialect.name == 'mssql':
+                db.session.execute(dbutils.mssql_merge(
+                    dialect, table, batch, conflict_columns, batch_update_columns, update_values
+                ))
+            else:
+                insert = postgresql.insert if dialect.name == 'postgresql' else sqlite.insert
+                stmt = insert(table)
+                set_ = {key: stmt.excluded[key] for key in batch_update_columns}
+                set_.update(update_values)
+                if set_:
+                    stmt = stmt.on_conflict_do_update(index_elements=key_columns, set_=set_)
+                else:
+                    stmt = stmt.on_conflict_do_nothing(index_elements=key_columns)
+
+                if dialect.name == 'postgresql':
+                    # xmax is only zero on a row version the statement inserted
+                    stmt = stmt.returning(
+                        *key_columns, sa.literal_column('xmax = 0').label('inserted')
+                    )
+                    for *key, inserted in db.session.execute(stmt, batch):
+                        key = key[0] if len(key) == 1 else tuple(key)
+                        if inserted:
+                            existing.discard(key)
+                else:
+                    db.session.execute(stmt, batch)
+
+            for row in batch:
+                key = row_key(row)
+                statuses.setdefault(key, 'updated' if key in existing else 'created')
+
+        return statuses
+
     def update_collection(self, attr_name, data):
         """Update the specified relationship collection with the given data.
 
@@ -553,6 +1198,39 @@ class SoftDeleteMixin:
 
     deleted_utc = sa.Column(ArrowType, nullable=True)
 
+    default_active_only = False
+    """Set on the entity to exclude soft-deleted records from all ORM SELECTs of the entity,
+    unless the query is marked with ``with_deleted``. Note that ``get`` returns records already
+    in the session's identity map without a SELECT."""
+
+    @classmethod
+    def active_query(cls):
+        """Entity query that excludes soft-deleted records, including those of any soft-delete
+        entities joined or loaded through relationships. Undo with ``with_deleted``."""
+        return cls.query.execution_options(active_only=True)
+
+    @staticmethod
+    def with_deleted(query):
+        """Include soft-deleted records in the query, even if filtered by default."""
+        return query.execution_options(include_deleted=True)
+
+    @staticmethod
+    def active_index(name, *columns, **kwargs):
+        """Partial index covering only records that are not soft-deleted, for use in
+        ``__table_args__``. Keeps indexes on tables with many deleted records small::
+
+            class MyEntity(SoftDeleteMixin, MethodsMixin, Model):
+                __table_args__ = (
+                    SoftDeleteMixin.active_index('ix_my_entity_name', 'name'),
+                )
+
+        The index is partial on PostgreSQL, SQLite and MSSQL. Other dialects get a full index.
+        """
+        where = sa.text('deleted_utc IS NULL')
+        for dialect in ('postgresql', 'sqlite', 'mssql'):
+            kwargs.setdefault('{}_where'.format(dialect), where)
+        return sa.Index(name, *columns, **kwargs)
+
     @might_commit
     @might_flush
     @classmethod
@@ -568,6 +1246,59 @@ class SoftDeleteMixin:
             synchronize_session=False
         ) > 0
 
+    @might_commit
+    @might_flush
+    @classmethod
+    def delete_many(cls, ids_or_clause, batch_size=1000):
+        """Soft-delete many records, with a single UPDATE per batch.
+
+        Records already deleted keep their original ``deleted_utc``.
+
+        :param ids_or_clause: iterable of primary key values (tuples in the order of
+            ``primary_keys()`` for multiple primary key entities), or a SQLAlchemy clause
+            selecting the records to delete.
+        :param batch_size: maximum number of ids to update in a single statement.
+        :param _commit: enable/disable commit. Default True.
+        :param _flush: enable/disable flush. Default True.
+        :return: number of records deleted.
+        """
+        return cls._set_deleted_utc(ids_or_clause, arrow.utcnow(), batch_size)
+
+    @might_commit
+    @might_flush
+    @classmethod
+    def restore_many(cls, ids_or_clause, batch_size=1000):
+        """Restore many soft-deleted records, with a single UPDATE per batch.
+
+        :param ids_or_clause: as with ``delete_many``.
+        :param batch_size: maximum number of ids to update in a single statement.
+        :param _commit: enable/disable commit. Default True.
+        :param _flush: enable/disable flush. Default True.
+        :return: number of records restored.
+        """
+        return cls._set_deleted_utc(ids_or_clause, None, batch_size)
+
+    @classmethod
+    def _set_deleted_utc(cls, ids_or_clause, value, batch_size):
+        state_clause = (
+            cls.deleted_utc.is_(None) if value is not None else cls.deleted_utc.isnot(None)
+        )
+
+        def update(clause):
+            return cls.query.filter(clause, state_clause).update(
+                {'deleted_utc': value},
+                synchronize_session=False
+            )
+
+        if isinstance(ids_or_clause, sa.sql.ClauseElement):
+            return update(ids_or_clause)
+
+        primary_keys = list(cls.primary_keys())
+        return sum(
+            update(dbutils.columns_in(primary_keys, batch))
+            for batch in dbutils.chunked(ids_or_clause, batch_size)
+        )
+
     @might_commit
     @might_flush
     @classmethod
@@ -575,6 +1306,11 @@ class SoftDeleteMixin:
         kwargs.setdefault('deleted_utc', arrow.utcnow() if _is_deleted else None)
         return super().fake(*args, **kwargs)
 
+    @classmethod
+    def fake_many(cls, *args, _is_deleted=False, **kwargs):
+        kwargs.setdefault('deleted_utc', arrow.utcnow() if _is_deleted else None)
+        return super().fake_many(*args, **kwargs)
+
     @staticmethod
     def sqla_before_delete_event(mapper, connection, target):
         if hasattr(target, 'before_delete_event'):
@@ -593,6 +1329,154 @@ sa.event.listen(SoftDeleteMixin, 'before_delete', SoftDeleteMixin.sqla_before_de
                 propagate=True)
 
 
+@sa.event.listens_for(sa.orm.Session, 'do_orm_execute')
+def _soft_delete_criteria(orm_execute_state):
+    options = orm_execute_state.execution_options
+    if (
+        not orm_execute_state.is_select
+        or orm_execute_state.is_column_load
+        or options.get('include_deleted', False)
+    ):
+        return
+
+    if options.get('active_only', False):
+        entity_classes = [SoftDeleteMixin]
+    else:
+        entity_classes = [
+            mapper.class_ for mapper in orm_execute_state.all_mappers
+            if getattr(mapper.class_, 'default_active_only', False)
+        ]
+        if not entity_classes:
+            return
+
+    # loader criteria also propagate to relationship loads of the statement's results
+    orm_execute_state.statement = orm_execute_state.statement.options(*(
+        sa.orm.with_loader_criteria(
+            entity_cls,
+            lambda cls: cls.deleted_utc.is_(None),
+            include_aliases=True,
+        )
+        for entity_cls in entity_classes
+    ))
+
+
+class LookupCache:
+    """Process-level cache of lookup table data, used by ``LookupMixin`` when enabled.
+
+    Entries expire after their TTL, and are dropped for a table whenever a write to it is
+    flushed, executed, committed or rolled back through a SQLAlchemy session. Other processes
+    do not see those writes, so the TTL bounds how stale a cached value may get.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get_or_create(self, entity_cls, key, ttl, creator):
+        """Return the cached value for the entity class and key, calling `creator` to build
+        the value if it is missing or expired."""
+        cache_key = (entity_cls, key)
+        entry = self._entries.get(cache_key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        table = entity_cls.__table__
+        generation = self._generations.get(table, 0)
+        value = creator()
+        with self._lock:
+            # don't store a value that may have been read before a write invalidated the table
+            if self._generations.get(table, 0) == generation:
+                self._entries[cache_key] = (time.monotonic() + ttl, value)
+        return value
+
+    def invalidate(self, entity_cls=None):
+        """Drop cached values for the entity class's table, or everything if not given."""
+        if entity_cls is None:
+            with self._lock:
+                for table in self._generations:
+                    self._generations[table] += 1
+                self._entries.clear()
+        else:
+            self.invalidate_tables({entity_cls.__table__})
+
+    def invalidate_tables(self, tables):
+        """Drop cached values for all entity classes mapped to the given tables."""
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+            for cache_key in [key for key in self._entries if key[0].__table__ in tables]:
+                del self._entries[cache_key]
+
+
+lookup_cache = LookupCache()
+"""Cache instance shared by all ``LookupMixin`` entities."""
+
+_lookup_tables_info_key = 'keg_elements.lookup_tables'
+
+
+def _invalidate_lookup_tables(session, tables):
+    if not tables:
+        return
+    lookup_cache.invalidate_tables(tables)
+    # also invalidate at transaction end, in case other sessions have read uncommitted state
+    session.info.setdefault(_lookup_tables_info_key, set()).update(tables)
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_flush')
+def _lookup_cache_after_flush(session, flush_context):
+    objs = itertools.chain(session.new, session.dirty, session.deleted)
+    tables = {type(obj).__table__ for obj in objs if isinstance(obj, LookupMixin)}
+    _invalidate_lookup_tables(session, tables)
+
+
+@sa.event.listens_for(sa.orm.Session, 'do_orm_execute')
+def _lookup_cache_orm_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update \
+            or orm_execute_state.is_delete:
+        table = orm_execute_state.statement.table
+        _invalidate_lookup_tables(orm_execute_state.session, {table})
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_commit')
+@sa.event.listens_for(sa.orm.Session, 'after_rollback')
+def _lookup_cache_transaction_end(session):
+    lookup_cache.invalidate_tables(session.info.pop(_lookup_tables_info_key, set()))
+
+
+class ActiveComparator(sa.ext.hybrid.Comparator):
+    """Comparator for a soft-delete ``is_active`` hybrid, given the ``deleted_utc`` column.
+
+    Boolean comparisons compile to ``IS NULL``/``IS NOT NULL`` checks on the column, so that the
+    database can use an index, rather than comparing a computed value.
+    """
+
+    def __clause_element__(self):
+        return sa.sql.case((self.expression.is_(None), sa.true()), else_=sa.false())
+
+    @staticmethod
+    def _as_bool(other):
+        if isinstance(other, bool):
+            return other
+        if isinstance(other, sa.sql.elements.True_):
+            return True
+        if isinstance(other, sa.sql.elements.False_):
+            return False
+        return None
+
+    def operate(self, op, *other, **kwargs):
+        if op in (operators.eq, operators.ne, operators.is_, operators.is_not):
+            value = self._as_bool(other[0])
+            if value is not None:
+                if op in (operators.ne, operators.is_not):
+                    value = not value
+                return self.expression.is_(None) if value else self.expression.isnot(None)
+        return op(self.__clause_element__(), *other, **kwargs)
+
+    def reverse_operate(self, op, other, **kwargs):
+        return op(other, self.__clause_element__(), **kwargs)
+
+
 class LookupMixin(SoftDeleteMixin):
     """Provides a base for id/label pair tables, used in one-to-many relationships.
 
@@ -611,17 +1495,25 @@ class LookupMixin(SoftDeleteMixin):
     label = sa.Column(sa.Unicode(255), nullable=False, unique=True)
     code = sa.Column(sa.Unicode(255))
 
+    lookup_cache_ttl = None
+    """Seconds to keep lookup pairs and the code/label index in the process-level
+    ``lookup_cache``. Set on the entity to opt in to caching; the default of None disables it."""
+
     @hybrid_property
     def is_active(self):
         """Hybrid property returning a record's active status.
 
         By default, deleted == inactive.
+
+        At the class level, comparing against a boolean (``Entity.is_active == True``) produces
+        a plain ``deleted_utc IS [NOT] NULL`` predicate, which can use an index on
+        ``deleted_utc``. Used as a column expression, it gives a boolean CASE expression.
         """
-        return self.deleted_utc is not None
+        return self.deleted_utc is None
 
-    @is_active.expression
+    @is_active.comparator
     def is_active(cls):
-        return sa.sql.case((cls.deleted_utc.is_(None), sa.true()), else_=sa.false())
+        return ActiveComparator(cls.deleted_utc)
 
     @classmethod
     def _active_query(cls, include_ids=None, order_by=None):
@@ -631,11 +1523,11 @@ class LookupMixin(SoftDeleteMixin):
         if include_ids:
             include_ids = tolist(include_ids)
             clause = sa.sql.or_(
-                cls.is_active == sa.true(),
+                cls.deleted_utc.is_(None),
                 cls.id.in_(include_ids)
             )
         else:
-            clause = cls.is_active == sa.true()
+            clause = cls.deleted_utc.is_(None)
 
         return cls.query.filter(clause).order_by(order_by)
 
@@ -655,18 +1547,71 @@ class LookupMixin(SoftDeleteMixin):
         :param include_ids: iterable of int ids that should be included even if inactive.
         :param order_by: column designation to use for SQLAlchemy when sorting values.
         """
+        if cls.lookup_cache_ttl is None:
+            return cls._pairs_active(include_ids, order_by)
+
+        key = (
+            'pairs_active',
+            tuple(sorted(tolist(include_ids))) if include_ids else None,
+            None if order_by is None else str(order_by),
+        )
+        pairs = lookup_cache.get_or_create(
+            cls, key, cls.lookup_cache_ttl, lambda: cls._pairs_active(include_ids, order_by)
+        )
+        return list(pairs)
+
+    @classmethod
+    def _pairs_active(cls, include_ids=None, order_by=None):
         query = cls._active_query(include_ids, order_by)
         return cls.pairs('id', 'label', query=query)
 
+    @classmethod
+    def _lookup_index(cls):
+        """Cached code -> id and label -> id dicts. Codes are not unique, so a code held by
+        multiple records maps to None."""
+        def build_index():
+            by_code = {}
+            by_label = {}
+            for ident, code, label in db.session.execute(sa.select(cls.id, cls.code, cls.label)):
+                if code is not None:
+                    by_code[code] = None if code in by_code else ident
+                by_label[label] = ident
+            return by_code, by_label
+
+        return lookup_cache.get_or_create(cls, 'index', cls.lookup_cache_ttl, build_index)
+
+    @classmethod
+    def _get_indexed(cls, field, value):
+        by_code, by_label = cls._lookup_index()
+        index = by_code if field == 'code' else by_label
+        if value not in index:
+            return None
+        ident = index[value]
+        if ident is None:
+            # ambiguous code, let the query raise
+            return cls.get_by(**{field: value})
+        # hits the session's identity map when the record is already loaded
+        return cls.get(ident)
+
     @classmethod
     def get_by_label(cls, label):
-        """Fetch a lookup record by its label field."""
-        return cls.get_by(label=label)
+        """Fetch a lookup record by its label field.
+
+        Uses the cached label index when ``lookup_cache_ttl`` is set.
+        """
+        if cls.lookup_cache_ttl is None:
+            return cls.get_by(label=label)
+        return cls._get_indexed('label', label)
 
     @classmethod
     def get_by_code(cls, code):
-        """Fetch a lookup record by its code (internal) field."""
-        return cls.get_by(code=code)
+        """Fetch a lookup record by its code (internal) field.
+
+        Uses the cached code index when ``lookup_cache_ttl`` is set.
+        """
+        if cls.lookup_cache_ttl is None:
+            return cls.get_by(code=code)
+        return cls._get_indexed('code', code)
 
     def __repr__(self):
         return '<{} {}:{}>'.format(self.__class__.__name__, self.id, self.label)
@@ -1,8 +1,16 @@
+import base64
 import contextlib
+import datetime as dt
+import enum
+import itertools
+import json
 import math
 import random
+import uuid
 from decimal import Decimal
 
+import arrow
+
 import sqlalchemy as sa
 from sqlalchemy.sql import expression
 from sqlalchemy.ext.compiler import compiles
@@ -182,6 +190,179 @@ def randemail(length, randomizer=randchars):
             + '.' + randomizer(3, 'alpha'))
 
 
+def chunked(iterable, size):
+    """Split an iterable into lists of at most `size` items.
+
+    Used by the bulk entity operations to control how many rows go into a single statement.
+    """
+    if size < 1:
+        raise ValueError(_('size must be at least 1'))
+
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def columns_in(columns, values):
+    """Build a clause matching any of the given values for one or more columns.
+
+    :param columns: list of SA columns.
+    :param values: list of values for a single column, or tuples of values in column order.
+    :returns: ``IN`` clause, using a tuple comparison for multiple columns. MSSQL does not
+        support tuple comparisons, so OR'd equality checks are used there instead.
+    """
+    if len(columns) == 1:
+        return columns[0].in_(values)
+    if db.engine.dialect.name == 'mssql':
+        return sa.or_(*(
+            sa.and_(*(column == value for column, value in zip(columns, row)))
+            for row in values
+        ))
+    return sa.tuple_(*columns).in_(values)
+
+
+def python_default_value(default):
+    """Evaluate a Python-side column default or onupdate outside of statement execution.
+
+    Returns None for defaults that cannot be evaluated up front (sequences, server-side
+    or SQL expression defaults).
+    """
+    if default is None:
+        return None
+    if default.is_scalar:
+        return default.arg
+    if default.is_callable:
+        return default.arg(None)
+    return None
+
+
+def mssql_merge(dialect, table, rows, key_columns, update_columns, update_values=None):
+    """Build a MSSQL ``MERGE`` statement that upserts `rows` into `table`.
+
+    Python-side column defaults are applied to the inserted values, since the statement is not
+    compiled from an INSERT construct. MSSQL limits a statement to 2100 parameters, so the
+    caller is responsible for sizing `rows` appropriately.
+
+    :param dialect: SA dialect used to quote identifiers.
+    :param table: SA table to merge into.
+    :param rows: list of dicts keyed by column key. All dicts should have the same keys.
+    :param key_columns: list of column keys to match existing records on.
+    :param update_columns: list of column keys to update when a record matches.
+    :param update_values: optional dict of additional values to set when a record matches.
+    :returns: executable text clause.
+    """
+    preparer = dialect.identifier_preparer
+    update_values = update_values or {}
+
+    insert_columns = list(rows[0].keys())
+    defaults = {}
+    for column in table.columns:
+        if column.key not in insert_columns and not column.primary_key:
+            value = python_default_value(column.default)
+            if value is not None:
+                defaults[column.key] = value
+    insert_columns.extend(defaults.keys())
+
+    def col_name(key):
+        return preparer.quote(table.c[key].name)
+
+    bind_params = []
+    values_sql = []
+    for row_idx, row in enumerate(rows):
+        row = dict(defaults, **row)
+        names = []
+        for col_idx, key in enumerate(insert_columns):
+            name = 'v{}_{}'.format(row_idx, col_idx)
+            bind_params.append(sa.bindparam(name, row[key], type_=table.c[key].type))
+            names.append(':' + name)
+        values_sql.append('({})'.format(', '.join(names)))
+
+    set_sql = ['target.{0} = source.{0}'.format(col_name(key)) for key in update_columns]
+    for col_idx, (key, value) in enumerate(update_values.items()):
+        name = 'u{}'.format(col_idx)
+        bind_params.append(sa.bindparam(name, value, type_=table.c[key].type))
+        set_sql.append('target.{} = :{}'.format(col_name(key), name))
+
+    sql = [
+        'MERGE INTO {} WITH (HOLDLOCK) AS target'.format(preparer.format_table(table)),
+        'USING (VALUES {}) AS source ({})'.format(
+            ', '.join(values_sql),
+            ', '.join(col_name(key) for key in insert_columns),
+        ),
+        'ON {}'.format(' AND '.join(
+            'target.{0} = source.{0}'.format(col_name(key)) for key in key_columns
+        )),
+    ]
+    if set_sql:
+        sql.append('WHEN MATCHED THEN UPDATE SET {}'.format(', '.join(set_sql)))
+    sql.append('WHEN NOT MATCHED THEN INSERT ({0}) VALUES ({1});'.format(
+        ', '.join(col_name(key) for key in insert_columns),
+        ', '.join('source.{}'.format(col_name(key)) for key in insert_columns),
+    ))
+
+    return sa.text('\n'.join(sql)).bindparams(*bind_params)
+
+
+_cursor_decoders = {
+    'arrow': arrow.get,
+    'date': dt.date.fromisoformat,
+    'datetime': dt.datetime.fromisoformat,
+    'decimal': Decimal,
+    'time': dt.time.fromisoformat,
+    'uuid': uuid.UUID,
+}
+
+
+def encode_cursor(values):
+    """Encode a list of sort key values as an opaque, URL safe cursor string.
+
+    Supports str, int, float, bool and None, along with Decimal, date, time, datetime, UUID,
+    Arrow and enum (by name) values. Raises a ValueError for other types.
+    """
+    def encode_value(value):
+        if isinstance(value, arrow.Arrow):
+            return ['arrow', value.isoformat()]
+        if isinstance(value, dt.datetime):
+            return ['datetime', value.isoformat()]
+        if isinstance(value, dt.date):
+            return ['date', value.isoformat()]
+        if isinstance(value, dt.time):
+            return ['time', value.isoformat()]
+        if isinstance(value, Decimal):
+            return ['decimal', str(value)]
+        if isinstance(value, uuid.UUID):
+            return ['uuid', str(value)]
+        if isinstance(value, enum.Enum):
+            return value.name
+        if value is None or isinstance(value, (str, int, float)):
+            return value
+        raise ValueError(_('Unsupported cursor value type: {}').format(type(value).__name__))
+
+    data = json.dumps([encode_value(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor created by `encode_cursor` back to its list of values.
+
+    Raises a ValueError if the cursor is not valid.
+    """
+    def decode_value(value):
+        if isinstance(value, list):
+            type_name, encoded = value
+            return _cursor_decoders[type_name](encoded)
+        return value
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return [decode_value(value) for value in values]
+    except (TypeError, ValueError, KeyError, ArithmeticError):
+        raise ValueError(_('Invalid cursor'))
+
+
 def session_commit():
     """Commit the db session, and roll back if there is a failure.
 
@@ -221,6 +402,7 @@ class CollectionUpdater(object):
         self.attr_name = attr_name
         self.data = data
         self.keep_children = set()
+        self._child_index = None
         ent_cls = entity.__class__
 
         with db.session.no_autoflush:
@@ -231,24 +413,27 @@ class CollectionUpdater(object):
             rel_prop = queryable_attr.property
             # now that we have the property, go through the mapper to get to the child entity class
             self.child_cls = rel_prop.mapper.class_
+            self.child_keys = [column.key for column in self.child_cls.primary_keys()]
+
+    @property
+    def child_index(self):
+        """Collection records keyed by their primary key values, built on first access."""
+        if self._child_index is None:
+            with db.session.no_autoflush:
+                self._child_index = {
+                    tuple(getattr(child, key) for key in self.child_keys): child
+                    for child in self.collection
+                }
+        return self._child_index
 
     def find_child(self, data):
         """Find the child record associated with the related object"""
-        with db.session.no_autoflush:
-            child_entity_keys = self.child_cls.primary_keys()
-            supplied_keys = set(data.get(column.key)
-                                for column in child_entity_keys)
-
-            if None in supplied_keys:
-                return None
-
-            for child in self.collection:
-                record_keys = set(getattr(child, col.key)
-                                  for col in child_entity_keys)
-                if record_keys == supplied_keys:
-                    return child
+        supplied_keys = tuple(data.get(key) for key in self.child_keys)
+        if None in supplied_keys:
             return None
 
+        return self.child_index.get(supplied_keys)
+
     def update(self):
         """Update the objects associated with the entity
 
@@ -282,11 +467,22 @@ class CollectionUpdater(object):
             for child, record in to_edit:
                 child.edit(_commit=False, **record)
 
-            for record in to_add:
-                child = self.child_cls.add(_commit=False, **record)
+            for child in self.child_cls.add_many(to_add, _commit=False):
                 self.collection.append(child)
 
     def _remove_unmodified(self):
-        remove_children = [child for child in self.collection if child not in self.keep_children]
-        for child in remove_children:
-            self.collection.remove(child)
+        keep_children = [child for child in self.collection if child in self.keep_children]
+        if len(keep_children) == len(self.collection):
+            return
+
+        if isinstance(self.collection, list):
+            # replacing a list collection lets SA diff it in one pass, rather than a linear
+            # search for each removed record
+            setattr(self.entity, self.attr_name, keep_children)
+            self.collection = getattr(self.entity, self.attr_name)
+        else:
+            remove_children = [child for child in self.collection
+                               if child not in self.keep_children]
+            for child in remove_children:
+                self.collection.remove(child)
+        self._child_index = None
@@ -56,6 +56,63 @@ class TestColumns(object):
         assert obj.encrypted2 == 'Bar'
         assert obj.encrypted3 == 'Baz'
 
+    def test_encrypted_key_cached(self):
+        key_func = mock.Mock(return_value=b'a' * 40)
+        column_type = columns.EncryptedUnicode(key=key_func)
+
+        encrypted = column_type.process_bind_param('Foo', None)
+        assert column_type.process_result_value(encrypted, None) == 'Foo'
+        assert column_type.key == b'a' * 32
+        assert key_func.call_count == 1
+
+        column_type.invalidate_key()
+        key_func.return_value = b'b' * 32
+        assert column_type.key == b'b' * 32
+        assert key_func.call_count == 2
+
+        uncached = columns.EncryptedUnicode(key=key_func, cache_key=False)
+        uncached.key
+        uncached.key
+        assert key_func.call_count == 4
+
+    def test_encrypted_key_validation(self):
+        with pytest.raises(ValueError, match='at least 32 bytes'):
+            columns.EncryptedUnicode(key=[b'a' * 32, b'short']).keys
+        with pytest.raises(ValueError, match='At least one key'):
+            columns.EncryptedUnicode(key=[]).keys
+
+    def test_encrypted_multiple_keys(self):
+        old_type = columns.EncryptedUnicode(key=b'a' * 32)
+        new_type = columns.EncryptedUnicode(key=[b'b' * 32, b'a' * 32])
+
+        old_encrypted = old_type.process_bind_param('Foo', None)
+        new_encrypted = new_type.process_bind_param('Bar', None)
+        assert new_type.process_result_value(old_encrypted, None) == 'Foo'
+        assert new_type.process_result_value(new_encrypted, None) == 'Bar'
+        assert columns.EncryptedUnicode(key=b'b' * 32).process_result_value(
+            new_encrypted, None) == 'Bar'
+
+    def test_encrypted_rotate(self):
+        ents.ColumnTester.delete_cascaded()
+        column_type = ents.ColumnTester.__table__.c.encrypted4.type
+        ids = [ents.ColumnTester.fake(encrypted4='value{}'.format(i)).id for i in range(5)]
+        ents.ColumnTester.fake(encrypted4=None)
+
+        try:
+            ents.rotating_keys[:] = [b'e' * 32, b'd' * 32]
+            assert columns.EncryptedUnicode.rotate(
+                ents.ColumnTester, ents.ColumnTester.encrypted4, batch_size=2) == 5
+
+            ents.rotating_keys[:] = [b'e' * 32]
+            column_type.invalidate_key()
+            db.session.remove()
+            assert [
+                db.session.get(ents.ColumnTester, ident).encrypted4 for ident in ids
+            ] == ['value{}'.format(i) for i in range(5)]
+        finally:
+            ents.rotating_keys[:] = [b'd' * 32]
+            column_type.invalidate_key()
+
 
 class TestDBEnum:
     class Status(columns.DBEnum):
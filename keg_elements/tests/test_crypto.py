@@ -1,9 +1,12 @@
-from io import BytesIO
+import asyncio
+import concurrent.futures
+from io import BufferedReader, BytesIO
+from unittest import mock
 
 import cryptography
 import pytest
 from blazeutils import randchars
-from cryptography.hazmat.primitives import ciphers
+from cryptography.hazmat.primitives import ciphers, padding
 
 from keg_elements import crypto
 
@@ -39,6 +42,35 @@ def test_decrypt():
         )
 
 
+def test_fernet_cipher_cached():
+    crypto.clear_fernet_cache()
+    cipher = crypto.fernet_cipher(CRYPTO_KEY)
+    assert crypto.fernet_cipher(bytearray(CRYPTO_KEY)) is cipher
+    assert crypto.fernet_cipher(b'a' * 32) is not cipher
+
+    for i in range(crypto.FERNET_CACHE_SIZE):
+        crypto.fernet_cipher(b'%032d' % i)
+    assert crypto.fernet_cipher(CRYPTO_KEY) is not cipher
+
+    cipher = crypto.fernet_cipher(CRYPTO_KEY)
+    crypto.clear_fernet_cache()
+    assert crypto.fernet_cipher(CRYPTO_KEY) is not cipher
+
+    with pytest.raises(ValueError):
+        crypto.fernet_cipher(b'short')
+
+
+def test_encrypt_decrypt_many():
+    data = [b'\x01\x02', b'', b'foo']
+    encrypted = crypto.encrypt_many(iter(data), CRYPTO_KEY)
+    assert len(encrypted) == 3
+    assert [crypto.decrypt(token, CRYPTO_KEY) for token in encrypted] == data
+    assert crypto.decrypt_many(encrypted, CRYPTO_KEY) == data
+
+    with pytest.raises(cryptography.fernet.InvalidToken):
+        crypto.decrypt_many(encrypted, b'a' * 32)
+
+
 def test_encrypt_str():
     s = randchars()
     encrypted = crypto.encrypt_str(s, CRYPTO_KEY)
@@ -174,7 +206,9 @@ class TestStreamEncryption:
         bio_fobj = crypto.decrypt_bytesio(CRYPTO_KEY, enc_fpath)
         assert bio_fobj.read() == b'just some text'
 
-    def test_decrypt_file(self, tmpdir):
+    def test_decrypt_file(self, tmpdir, monkeypatch):
+        # the implicit output file name has no directory, keep it out of the working tree
+        monkeypatch.chdir(tmpdir)
         fobj = tmpdir.join('tempfile.txt')
         fobj.write('just some text')
         enc_fpath = crypto.encrypt_file(CRYPTO_KEY, fobj.strpath)
@@ -212,3 +246,389 @@ class TestStreamEncryption:
 
         with open(enc_fpath, 'rb') as infile:
             crypto.decrypt_fileobj(CRYPTO_KEY, infile, bio, 24 * 1024)
+
+
+class TestBufferedStreamEncryption:
+    """Buffer reusing paths produce and accept the same format as the generator API."""
+
+    @pytest.mark.parametrize('bytes_count', [0, 1, 15, 16, 17, 48, 100])
+    @pytest.mark.parametrize('chunksize', [16, 32, 24])
+    def test_encrypt_fileobj_into(self, bytes_count, chunksize):
+        value = randchars(bytes_count).encode()
+        encrypted = BytesIO()
+        crypto.encrypt_fileobj_into(CRYPTO_KEY, BytesIO(value), encrypted, chunksize)
+
+        out = BytesIO()
+        crypto.decrypt_fileobj(CRYPTO_KEY, BytesIO(encrypted.getvalue()), out, 7)
+        assert out.getvalue() == value
+
+        generated = b''.join(crypto.encrypt_fileobj(CRYPTO_KEY, BytesIO(value), chunksize))
+        out = BytesIO()
+        crypto.decrypt_fileobj(CRYPTO_KEY, BytesIO(generated), out, chunksize)
+        assert out.getvalue() == value
+
+    def test_readinto_not_required(self):
+        class ReadOnly:
+            def __init__(self, data):
+                self.bio = BytesIO(data)
+
+            def read(self, size=-1):
+                return self.bio.read(min(size, 5))
+
+        encrypted = BytesIO()
+        crypto.encrypt_fileobj_into(CRYPTO_KEY, ReadOnly(b'a' * 50), encrypted, 16)
+        out = BytesIO()
+        crypto.decrypt_fileobj(CRYPTO_KEY, ReadOnly(encrypted.getvalue()), out, 16)
+        assert out.getvalue() == b'a' * 50
+
+    def test_empty_file(self, tmpdir):
+        fobj = tmpdir.join('empty.txt')
+        fobj.write(b'')
+        enc_fpath = crypto.encrypt_file(CRYPTO_KEY, fobj.strpath)
+        assert crypto.decrypt_bytesio(CRYPTO_KEY, enc_fpath).read() == b''
+
+    def test_truncated(self):
+        encrypted = b''.join(crypto.encrypt_fileobj(CRYPTO_KEY, BytesIO(b'a' * 20)))
+        with pytest.raises(ValueError):
+            crypto.decrypt_fileobj(CRYPTO_KEY, BytesIO(encrypted[:-1]), BytesIO(), 16)
+
+    def test_invalid_file(self, tmpdir):
+        """Decrypting memory mapped files raises the decryption error, not a BufferError."""
+        # fixed IV, so decrypting with the wrong key deterministically hits invalid padding
+        iv = b'i' * 16
+        padder = padding.PKCS7(128).padder()
+        encryptor = crypto.aes_cipher(CRYPTO_KEY, iv).encryptor()
+        encrypted = iv + encryptor.update(padder.update(b'a' * 100) + padder.finalize()) \
+            + encryptor.finalize()
+
+        enc_fobj = tmpdir.join('invalid.enc')
+        out_fpath = tmpdir.join('out.txt').strpath
+        for data, key in [(encrypted, b'b' * 32), (encrypted[:-1], CRYPTO_KEY)]:
+            enc_fobj.write(data, mode='wb')
+            for chunksize in (7, 16, 1024):
+                with pytest.raises(ValueError):
+                    crypto.decrypt_bytesio(key, enc_fobj.strpath, chunksize)
+                with pytest.raises(ValueError):
+                    crypto.decrypt_file(key, enc_fobj.strpath, out_fpath, chunksize)
+
+
+class TestAuthenticatedStreamEncryption:
+    def encrypt(self, data, chunksize=16, key=CRYPTO_KEY):
+        return b''.join(crypto.encrypt_stream(key, BytesIO(data), chunksize=chunksize))
+
+    def decrypt(self, data, key=CRYPTO_KEY, **kwargs):
+        return b''.join(crypto.decrypt_stream(key, BytesIO(data), **kwargs))
+
+    @pytest.mark.parametrize('bytes_count', [0, 1, 15, 16, 17, 32, 100])
+    def test_encrypt_decrypt(self, bytes_count):
+        value = randchars(bytes_count).encode()
+        encrypted = self.encrypt(value)
+
+        chunk_count = max(1, -(-bytes_count // 16))
+        assert len(encrypted) == crypto.STREAM_HEADER_SIZE + bytes_count + 16 * chunk_count
+        assert encrypted != self.encrypt(value)
+        assert self.decrypt(encrypted) == value
+
+    def test_short_reads(self):
+        class TrickleIO(BytesIO):
+            def read(self, size=-1):
+                return super().read(min(size, 5))
+
+        value = b'abc' * 20
+        encrypted = b''.join(crypto.encrypt_stream(CRYPTO_KEY, TrickleIO(value), chunksize=16))
+        assert b''.join(crypto.decrypt_stream(CRYPTO_KEY, TrickleIO(encrypted))) == value
+
+    def test_incremental_decrypt(self):
+        encrypted = self.encrypt(b'a' * 16 + b'b' * 16 + b'c' * 4)
+        # damage the last chunk; verified chunks before it are still released
+        encrypted = encrypted[:-1] + bytes([encrypted[-1] ^ 1])
+        chunks = crypto.decrypt_stream(CRYPTO_KEY, BytesIO(encrypted))
+        assert next(chunks) == b'a' * 16
+        assert next(chunks) == b'b' * 16
+        with pytest.raises(cryptography.exceptions.InvalidTag):
+            next(chunks)
+
+    def test_tampering_detected(self):
+        encrypted = self.encrypt(b'a' * 16 + b'b' * 16 + b'c' * 16)
+        header_size = crypto.STREAM_HEADER_SIZE
+        segment = 16 + crypto.STREAM_TAG_SIZE
+        header, chunks = encrypted[:header_size], encrypted[header_size:]
+
+        modified = [
+            # flipped bit
+            encrypted[:header_size + 3] + b'\xff' + encrypted[header_size + 4:],
+            # truncated at a chunk boundary
+            encrypted[:header_size + 2 * segment],
+            # no chunks
+            header,
+            # reordered chunks
+            header + chunks[segment:2 * segment] + chunks[:segment] + chunks[2 * segment:],
+            # chunk from another stream
+            self.encrypt(b'a' * 48)[:header_size] + chunks,
+        ]
+        for data in modified:
+            with pytest.raises(cryptography.exceptions.InvalidTag):
+                self.decrypt(data)
+
+        with pytest.raises(cryptography.exceptions.InvalidTag):
+            self.decrypt(encrypted, key=b'a' * 32)
+
+    def test_invalid_header(self):
+        with pytest.raises(ValueError, match='Not an encrypted stream'):
+            self.decrypt(b'')
+        with pytest.raises(ValueError, match='Not an encrypted stream'):
+            self.decrypt(b'x' * 100)
+
+        encrypted = self.encrypt(b'abc')
+        with pytest.raises(ValueError, match='Not an encrypted stream'):
+            self.decrypt(encrypted[:4] + b'\x02' + encrypted[5:])
+
+    def test_invalid_chunksize(self):
+        with pytest.raises(ValueError):
+            self.encrypt(b'abc', chunksize=0)
+
+    def test_max_chunksize(self):
+        encrypted = self.encrypt(b'abc')
+        offset = len(crypto.STREAM_MAGIC) + 1
+        forged = encrypted[:offset] + (2 ** 31).to_bytes(4, 'big') + encrypted[offset + 4:]
+        fileobj = BytesIO(forged)
+        with pytest.raises(ValueError, match='chunk size 2147483648 is not between'):
+            b''.join(crypto.decrypt_stream(CRYPTO_KEY, fileobj))
+        assert fileobj.tell() == crypto.STREAM_HEADER_SIZE
+
+        with pytest.raises(ValueError, match='chunk size 16 is not between 1 and 8'):
+            self.decrypt(encrypted, max_chunksize=8)
+        assert self.decrypt(encrypted, max_chunksize=16) == b'abc'
+
+    @pytest.mark.parametrize('workers', [None, 1, 3])
+    def test_parallel(self, workers):
+        value = randchars(1000).encode()
+        encrypted = b''.join(crypto.encrypt_stream(
+            CRYPTO_KEY, BytesIO(value), chunksize=16, workers=workers))
+        assert self.decrypt(encrypted) == value
+        assert b''.join(crypto.decrypt_stream(
+            CRYPTO_KEY, BytesIO(encrypted), workers=workers)) == value
+
+        tampered = encrypted[:-20] + bytes([encrypted[-20] ^ 1]) + encrypted[-19:]
+        with pytest.raises(cryptography.exceptions.InvalidTag):
+            b''.join(crypto.decrypt_stream(CRYPTO_KEY, BytesIO(tampered), workers=workers))
+
+    def test_parallel_closed_early(self):
+        chunks = crypto.encrypt_stream(
+            CRYPTO_KEY, BytesIO(b'a' * 1000), chunksize=16, workers=2)
+        assert len(next(chunks)) == crypto.STREAM_HEADER_SIZE
+        next(chunks)
+        chunks.close()
+
+    def test_stream_file(self, tmpdir):
+        fobj = tmpdir.join('tempfile.txt')
+        fobj.write('just some text')
+        enc_fpath = crypto.encrypt_stream_file(CRYPTO_KEY, fobj.strpath, workers=2)
+        assert enc_fpath == fobj.strpath + '.enc'
+        fobj.remove()
+
+        out_fpath = crypto.decrypt_stream_file(CRYPTO_KEY, enc_fpath, workers=2)
+        assert out_fpath == fobj.strpath
+        assert fobj.read() == 'just some text'
+
+        out_fpath = crypto.decrypt_stream_file(
+            CRYPTO_KEY, enc_fpath, tmpdir.join('explicit.txt').strpath)
+        assert tmpdir.join('explicit.txt').read() == 'just some text'
+
+        with pytest.raises(ValueError, match='doesn\'t end in ".enc" then'):
+            crypto.decrypt_stream_file(CRYPTO_KEY, tmpdir.join('wrong-name.txt').strpath)
+
+
+class TestEncryptedStreamReader:
+    def write(self, tmpdir, value, chunksize=16):
+        fobj = tmpdir.join('plain.txt')
+        fobj.write(value)
+        return crypto.encrypt_stream_file(CRYPTO_KEY, fobj.strpath, chunksize=chunksize)
+
+    @pytest.mark.parametrize('bytes_count', [0, 1, 16, 17, 100])
+    def test_read(self, tmpdir, bytes_count):
+        value = randchars(bytes_count).encode()
+        with crypto.open_encrypted(self.write(tmpdir, value), CRYPTO_KEY) as f:
+            assert f.size == bytes_count
+            assert f.read() == value
+            assert f.read() == b''
+            assert f.read(5) == b''
+
+    def test_random_access(self, tmpdir):
+        value = randchars(100).encode()
+        with crypto.open_encrypted(self.write(tmpdir, value), CRYPTO_KEY) as f:
+            for start, size in [(0, 5), (10, 30), (15, 1), (16, 16), (90, 50), (99, 1)]:
+                assert f.seek(start) == start
+                assert f.read(size) == value[start:start + size]
+                assert f.tell() == min(start + size, 100)
+
+            assert f.seek(-10, 2) == 90
+            assert f.read() == value[-10:]
+            f.seek(20)
+            assert f.seek(5, 1) == 25
+            assert f.read(3) == value[25:28]
+            f.seek(200)
+            assert f.read(5) == b''
+
+            with pytest.raises(ValueError):
+                f.seek(-1)
+
+            buffer = bytearray(20)
+            f.seek(30)
+            assert f.readinto(buffer) == 20
+            assert buffer == value[30:50]
+
+        assert f.closed
+        with pytest.raises(ValueError):
+            f.read()
+
+    def test_decrypts_covering_chunks(self, tmpdir):
+        value = randchars(100).encode()
+        with crypto.open_encrypted(self.write(tmpdir, value), CRYPTO_KEY) as f:
+            with mock.patch.object(f._params, 'decrypt_chunk',
+                                   wraps=f._params.decrypt_chunk) as decrypt_chunk:
+                f.seek(20)
+                f.read(20)
+            assert [call.args[0] for call in decrypt_chunk.call_args_list] == [1, 2]
+
+    def test_buffered(self, tmpdir):
+        value = randchars(100).encode()
+        with BufferedReader(crypto.open_encrypted(self.write(tmpdir, value), CRYPTO_KEY)) as f:
+            f.seek(50)
+            assert f.read(10) == value[50:60]
+
+    def test_tampering_detected(self, tmpdir):
+        enc_fpath = self.write(tmpdir, b'a' * 100)
+        with open(enc_fpath, 'rb') as f:
+            encrypted = f.read()
+        segment = 16 + crypto.STREAM_TAG_SIZE
+
+        # truncation at a chunk boundary is detected on open
+        with pytest.raises(cryptography.exceptions.InvalidTag):
+            crypto.EncryptedStreamReader(
+                CRYPTO_KEY, BytesIO(encrypted[:crypto.STREAM_HEADER_SIZE + 3 * segment]))
+
+        # modified chunks are detected when read
+        modified = bytearray(encrypted)
+        modified[crypto.STREAM_HEADER_SIZE + segment + 3] ^= 1
+        f = crypto.EncryptedStreamReader(CRYPTO_KEY, BytesIO(bytes(modified)))
+        assert f.read(16) == b'a' * 16
+        with pytest.raises(cryptography.exceptions.InvalidTag):
+            f.read(16)
+
+        with pytest.raises(cryptography.exceptions.InvalidTag):
+            crypto.open_encrypted(enc_fpath, b'b' * 32)
+        with pytest.raises(ValueError, match='Not an encrypted stream'):
+            crypto.EncryptedStreamReader(CRYPTO_KEY, BytesIO(b'not encrypted'))
+
+    def test_max_chunksize(self, tmpdir):
+        enc_fpath = self.write(tmpdir, b'a' * 100, chunksize=32)
+        with open(enc_fpath, 'rb') as f:
+            encrypted = f.read()
+        offset = len(crypto.STREAM_MAGIC) + 1
+        forged = encrypted[:offset] + (2 ** 31).to_bytes(4, 'big') + encrypted[offset + 4:]
+        with pytest.raises(ValueError, match='chunk size 2147483648 is not between'):
+            crypto.EncryptedStreamReader(CRYPTO_KEY, BytesIO(forged))
+
+        with pytest.raises(ValueError, match='chunk size 32 is not between 1 and 16'):
+            crypto.open_encrypted(enc_fpath, CRYPTO_KEY, max_chunksize=16)
+        with crypto.open_encrypted(enc_fpath, CRYPTO_KEY, max_chunksize=32) as f:
+            assert f.read() == b'a' * 100
+
+
+class TestAsyncEncryption:
+    class AsyncBytesIO:
+        """Reader/writer with coroutine methods, like aiofiles."""
+        def __init__(self, data=b''):
+            self.bio = BytesIO(data)
+
+        async def read(self, size=-1):
+            return self.bio.read(size)
+
+        async def write(self, data):
+            return self.bio.write(data)
+
+    class DrainWriter:
+        """Writer with a synchronous write and a drain coroutine, like asyncio.StreamWriter."""
+        def __init__(self):
+            self.bio = BytesIO()
+            self.drained = 0
+
+        def write(self, data):
+            self.bio.write(data)
+
+        async def drain(self):
+            self.drained += 1
+
+    @pytest.mark.parametrize('bytes_count', [0, 1, 16, 17, 100])
+    def test_encrypt_decrypt_fileobj(self, bytes_count):
+        value = randchars(bytes_count).encode()
+        encrypted = self.AsyncBytesIO()
+        asyncio.run(crypto.encrypt_fileobj_async(
+            CRYPTO_KEY, self.AsyncBytesIO(value), encrypted, chunksize=16))
+
+        out = BytesIO()
+        crypto.decrypt_fileobj(CRYPTO_KEY, BytesIO(encrypted.bio.getvalue()), out, 16)
+        assert out.getvalue() == value
+
+        decrypted = self.AsyncBytesIO()
+        asyncio.run(crypto.decrypt_fileobj_async(
+            CRYPTO_KEY, self.AsyncBytesIO(encrypted.bio.getvalue()), decrypted, chunksize=7))
+        assert decrypted.bio.getvalue() == value
+
+    def test_stream_reader_writer(self):
+        value = randchars(100).encode()
+        encrypted = b''.join(crypto.encrypt_fileobj(CRYPTO_KEY, BytesIO(value)))
+        writer = self.DrainWriter()
+
+        async def decrypt():
+            reader = asyncio.StreamReader()
+            reader.feed_data(encrypted)
+            reader.feed_eof()
+            await crypto.decrypt_fileobj_async(CRYPTO_KEY, reader, writer, chunksize=32)
+
+        asyncio.run(decrypt())
+        assert writer.bio.getvalue() == value
+        assert writer.drained >= 4
+
+    def test_bounded_reads(self):
+        """Reading stays at most one chunk ahead of writing."""
+        events = []
+
+        class Reader(self.AsyncBytesIO):
+            async def read(self, size=-1):
+                events.append('read')
+                return await super().read(size)
+
+        class Writer(self.AsyncBytesIO):
+            async def write(self, data):
+                events.append('write')
+                return await super().write(data)
+
+        asyncio.run(crypto.encrypt_fileobj_async(
+            CRYPTO_KEY, Reader(b'a' * 64), Writer(), chunksize=16))
+        reads_ahead = 0
+        for event in events:
+            reads_ahead += 1 if event == 'read' else -1
+            assert reads_ahead <= 2
+
+    def test_files(self, tmpdir):
+        fobj = tmpdir.join('tempfile.txt')
+        fobj.write('just some text')
+        enc_fpath = asyncio.run(crypto.encrypt_file_async(CRYPTO_KEY, fobj.strpath))
+        assert enc_fpath == fobj.strpath + '.enc'
+        assert crypto.decrypt_bytesio(CRYPTO_KEY, enc_fpath).read() == b'just some text'
+
+        out_fpath = tmpdir.join('out.txt').strpath
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            assert asyncio.run(crypto.decrypt_file_async(
+                CRYPTO_KEY, enc_fpath, out_fpath, executor=executor)) == out_fpath
+        assert tmpdir.join('out.txt').read() == 'just some text'
+
+        with pytest.raises(ValueError, match='doesn\'t end in ".enc" then'):
+            asyncio.run(crypto.decrypt_file_async(CRYPTO_KEY, fobj.strpath))
+
+    def test_too_short(self):
+        with pytest.raises(ValueError, match='too short'):
+            asyncio.run(crypto.decrypt_fileobj_async(
+                CRYPTO_KEY, self.AsyncBytesIO(b'abc'), self.AsyncBytesIO()))
@@ -1,6 +1,7 @@
 import io
 from contextlib import contextmanager
 from copy import copy
+from unittest import mock
 
 import pytest
 from alembic import op
@@ -125,6 +126,170 @@ class TestMigrationUtils:
             'ALTER TABLE abc.test_table ALTER COLUMN test_column SET NOT NULL;'
         ]
 
+    @contextmanager
+    def backfill_table(self, row_ids):
+        table = sa.Table(
+            'backfill_test',
+            sa.MetaData(),
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('test_column', sa.Unicode),
+        )
+        with db.engine.connect() as conn:
+            table.create(conn)
+            if row_ids:
+                conn.execute(table.insert(), [{'id': row_id} for row_id in row_ids])
+            conn.commit()
+            try:
+                yield table, conn
+            finally:
+                conn.rollback()
+                table.drop(conn)
+                conn.commit()
+
+    @pytest.mark.parametrize('autocommit', [False, True])
+    def test_backfill_column(self, autocommit):
+        progress = []
+        with self.backfill_table(range(1, 12)) as (table, conn):
+            with self.get_context(db.engine.dialect.name, connection=conn, as_sql=False) as context:
+                # Alembic begins a transaction around each migration it runs
+                with context.begin_transaction(_per_migration=True):
+                    migrations.backfill_column(
+                        op,
+                        'backfill_test',
+                        sa.Column('test_column', sa.Unicode),
+                        value='foo',
+                        batch_size=5,
+                        autocommit=autocommit,
+                        progress=lambda *args: progress.append(args),
+                    )
+            assert conn.execute(
+                sa.select(table.c.test_column).distinct()
+            ).scalars().all() == ['foo']
+
+        assert progress == [(1, 3), (2, 3), (3, 3)]
+
+    def test_backfill_column_query(self):
+        column = sa.Column('test_column', sa.Unicode)
+        query = sa.table('backfill_test', sa.column('id'), copy(column)).update().values(
+            test_column=sa.cast(sa.column('id'), sa.Unicode))
+
+        with self.backfill_table([3, 4, 10]) as (table, conn):
+            with self.get_context(db.engine.dialect.name, connection=conn, as_sql=False):
+                migrations.backfill_column(
+                    op, 'backfill_test', column, query=query, batch_size=2, sleep=0.001)
+            assert conn.execute(
+                sa.select(table.c.id, table.c.test_column).order_by(table.c.id)
+            ).all() == [(3, '3'), (4, '4'), (10, '10')]
+
+    def test_backfill_column_sparse_keys(self):
+        progress = []
+        row_ids = [1, 2, 1000, 100000, 100001]
+        with self.backfill_table(row_ids) as (table, conn):
+            with self.get_context(db.engine.dialect.name, connection=conn, as_sql=False), \
+                    mock.patch.object(migrations.time, 'sleep') as sleep:
+                migrations.backfill_column(
+                    op, 'backfill_test', sa.Column('test_column', sa.Unicode), value='foo',
+                    batch_size=2, sleep=1, progress=lambda *args: progress.append(args))
+            assert conn.execute(
+                sa.select(table.c.test_column)
+            ).scalars().all() == ['foo'] * len(row_ids)
+
+        assert progress == [(1, 3), (2, 3), (3, 3)]
+        assert sleep.call_count == 2
+
+    def test_backfill_column_empty_table(self):
+        with self.backfill_table([]) as (table, conn):
+            with self.get_context(db.engine.dialect.name, connection=conn, as_sql=False):
+                migrations.backfill_column(
+                    op, 'backfill_test', sa.Column('test_column', sa.Unicode), value='foo',
+                    progress=pytest.fail)
+
+    def test_backfill_column_offline(self):
+        with self.get_context('postgresql'):
+            with pytest.raises(ValueError, match='require an online migration'):
+                migrations.add_non_nullable_column(
+                    op,
+                    'test_table',
+                    sa.Column('test_column', sa.Unicode),
+                    default_value='foo',
+                    batch_size=100,
+                )
+
+            with pytest.raises(ValueError, match='Must provide exactly one of value or query'):
+                migrations.backfill_column(
+                    op, 'test_table', sa.Column('test_column', sa.Unicode))
+
+    def test_create_index_concurrently_postgres(self):
+        with self.get_context('postgresql') as context:
+            migrations.create_index_concurrently(
+                op, 'ix_test', 'test_table', ['col1', 'col2'], schema='abc')
+            migrations.drop_index_concurrently(op, 'ix_test', schema='abc')
+
+        assert context.statements() == [
+            'COMMIT;',
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_test ON abc.test_table (col1, col2);',
+            'BEGIN;',
+            'COMMIT;',
+            'DROP INDEX CONCURRENTLY IF EXISTS abc.ix_test;',
+            'BEGIN;',
+        ]
+
+    def test_create_index_concurrently_mssql(self):
+        with self.get_context('mssql') as context:
+            migrations.create_index_concurrently(
+                op, 'ix_test', 'test_table', ['col1'], schema='abc', unique=True)
+            migrations.create_index_concurrently(
+                op, 'ix_test2', 'test_table', ['col1'], mssql_online=False)
+            migrations.drop_index_concurrently(op, 'ix_test', 'test_table', schema='abc')
+
+        assert context.statements() == [
+            "IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_test' AND object_id = OBJECT_ID('abc.test_table')) CREATE UNIQUE INDEX ix_test ON abc.test_table (col1) WITH (ONLINE = ON);",  # noqa: E501
+            'GO',
+            "IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_test2' AND object_id = OBJECT_ID('test_table')) CREATE INDEX ix_test2 ON test_table (col1);",  # noqa: E501
+            'GO',
+            'DROP INDEX IF EXISTS ix_test ON abc.test_table;',
+            'GO',
+        ]
+
+    def test_create_index_concurrently_sqlite(self):
+        with self.get_context('sqlite') as context:
+            migrations.create_index_concurrently(op, 'ix_test', 'test_table', ['col1'])
+            migrations.drop_index_concurrently(op, 'ix_test')
+
+        assert context.statements() == [
+            'CREATE INDEX IF NOT EXISTS ix_test ON test_table (col1);',
+            'DROP INDEX IF EXISTS ix_test;',
+        ]
+
+    def test_create_index_concurrently_online(self):
+        table = sa.Table(
+            'index_test',
+            sa.MetaData(),
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('col1', sa.Unicode(50)),
+        )
+        with db.engine.connect() as conn:
+            table.create(conn)
+            conn.commit()
+            try:
+                with self.get_context(db.engine.dialect.name, connection=conn,
+                                      as_sql=False) as context, \
+                        context.begin_transaction(_per_migration=True):
+                    for _ in range(2):
+                        migrations.create_index_concurrently(op, 'ix_index_test', 'index_test',
+                                                             ['col1'])
+                    assert 'ix_index_test' in [
+                        index['name'] for index in sa.inspect(conn).get_indexes('index_test')
+                    ]
+
+                    for _ in range(2):
+                        migrations.drop_index_concurrently(op, 'ix_index_test', 'index_test')
+                    assert not sa.inspect(conn).get_indexes('index_test')
+            finally:
+                conn.rollback()
+                table.drop(conn)
+                conn.commit()
+
     def test_postgres_update_enum_options(self):
         with self.get_context('postgresql') as context:
             migrations.postgres_update_enum_options(
@@ -148,6 +313,121 @@ class TestMigrationUtils:
             'ALTER TABLE abc.test_table2 ALTER COLUMN test_column2 TYPE test_enum USING test_column2::test_enum;',  # noqa: E501
         ]
 
+    def test_postgres_update_enum_options_online_add_value(self):
+        with self.get_context('postgresql') as context:
+            plan = migrations.postgres_update_enum_options_online(
+                op,
+                [('public', 'test_table1', 'test_column1')],
+                'test_enum',
+                ['value0', 'value1', "value's", 'value2', 'value3'],
+                old_values=['value1', 'value2'],
+            )
+
+        assert plan == {
+            'strategy': 'add_value',
+            'added': ['value0', "value's", 'value3'],
+            'removed': [],
+        }
+        assert context.statements() == [
+            "ALTER TYPE test_enum ADD VALUE IF NOT EXISTS 'value0' BEFORE 'value1';",
+            "ALTER TYPE test_enum ADD VALUE IF NOT EXISTS 'value''s' AFTER 'value1';",
+            "ALTER TYPE test_enum ADD VALUE IF NOT EXISTS 'value3' AFTER 'value2';",
+        ]
+
+    def test_postgres_update_enum_options_online_recreate(self):
+        with self.get_context('postgresql') as context:
+            plan = migrations.postgres_update_enum_options_online(
+                op,
+                [
+                    ('public', 'test_table1', 'test_column1'),
+                    ('abc', 'test_table2', 'test_column2'),
+                ],
+                'test_enum',
+                ['value2', 'value1', 'value3'],
+                old_values=['value1', 'value2', 'value4'],
+            )
+
+        assert plan == {'strategy': 'recreate', 'added': ['value3'], 'removed': ['value4']}
+        assert context.statements() == [
+            "CREATE TYPE test_enum_new AS ENUM ('value2', 'value1', 'value3');",
+            'ALTER TABLE public.test_table1 ALTER COLUMN test_column1 DROP DEFAULT;',
+            'ALTER TABLE public.test_table1 ALTER COLUMN test_column1 TYPE test_enum_new USING test_column1::text::test_enum_new;',  # noqa: E501
+            'ALTER TABLE abc.test_table2 ALTER COLUMN test_column2 DROP DEFAULT;',
+            'ALTER TABLE abc.test_table2 ALTER COLUMN test_column2 TYPE test_enum_new USING test_column2::text::test_enum_new;',  # noqa: E501
+            'DROP TYPE test_enum;',
+            'ALTER TYPE test_enum_new RENAME TO test_enum;',
+        ]
+
+    def test_postgres_update_enum_options_online_schema(self):
+        with self.get_context('postgresql') as context:
+            migrations.postgres_update_enum_options_online(
+                op,
+                [('abc', 'test_table', 'test_column')],
+                'test_enum',
+                ['value2', 'value1'],
+                old_values=['value1', 'value2'],
+                schema='abc',
+            )
+            migrations.postgres_update_enum_options_online(
+                op,
+                [('abc', 'test_table', 'test_column')],
+                'test_enum',
+                ['value2', 'value1', 'value3'],
+                old_values=['value2', 'value1'],
+                schema='abc',
+            )
+
+        assert context.statements() == [
+            "CREATE TYPE abc.test_enum_new AS ENUM ('value2', 'value1');",
+            'ALTER TABLE abc.test_table ALTER COLUMN test_column DROP DEFAULT;',
+            'ALTER TABLE abc.test_table ALTER COLUMN test_column TYPE abc.test_enum_new USING test_column::text::abc.test_enum_new;',  # noqa: E501
+            'DROP TYPE abc.test_enum;',
+            'ALTER TYPE abc.test_enum_new RENAME TO test_enum;',
+            "ALTER TYPE abc.test_enum ADD VALUE IF NOT EXISTS 'value3' AFTER 'value1';",
+        ]
+
+    def test_postgres_update_enum_options_online_unchanged(self):
+        with self.get_context('postgresql') as context:
+            plan = migrations.postgres_update_enum_options_online(
+                op, [('public', 'test_table1', 'test_column1')], 'test_enum', ['a', 'b'],
+                old_values=['a', 'b'],
+            )
+        assert plan['strategy'] == 'none'
+        assert context.statements() == []
+
+    def test_postgres_update_enum_options_online_offline_requires_values(self):
+        with self.get_context('postgresql'):
+            with pytest.raises(ValueError, match='old_values is required'):
+                migrations.postgres_update_enum_options_online(
+                    op, [('public', 'test_table1', 'test_column1')], 'test_enum', ['a'])
+
+    def test_postgres_update_enum_options_online_dry_run(self):
+        if db.engine.dialect.name != 'postgresql':
+            pytest.skip('Postgres only test')
+
+        with db.engine.connect() as conn:
+            with self.get_context('postgresql', connection=conn, as_sql=False):
+                enum = sa.Enum('value1', 'value2', name='test_dry_run_enum')
+                table = sa.Table('test_dry_run', sa.MetaData(), sa.Column('col', enum))
+                table.create(conn)
+                conn.execute(table.insert(), [{'col': 'value1'}] * 10)
+                conn.execute(sa.text('ANALYZE test_dry_run'))
+
+                plan = migrations.postgres_update_enum_options_online(
+                    op, [(None, 'test_dry_run', 'col')], 'test_dry_run_enum', ['value1'],
+                    dry_run=True,
+                )
+                assert plan == {
+                    'strategy': 'recreate',
+                    'added': [],
+                    'removed': ['value2'],
+                    'estimated_rows': {(None, 'test_dry_run'): 10},
+                }
+                assert migrations.postgres_get_enum_values(op, 'test_dry_run_enum') == [
+                    'value1', 'value2'
+                ]
+            conn.rollback()
+
     def test_postgres_get_enum_values(self):
         if db.engine.dialect.name != 'postgresql':
             pytest.skip('Postgres only test')
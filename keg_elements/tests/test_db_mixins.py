@@ -1,4 +1,5 @@
 import datetime
+import time
 from decimal import Decimal
 
 from keg.db import db
@@ -9,6 +10,7 @@ import sqlalchemy as sa
 import sqlalchemy_utils as sautils
 import keg_elements.db.mixins as mixins
 import keg_elements.db.columns as columns
+import keg_elements.db.utils as dbutils
 
 import kegel_app.model.entities as ents
 
@@ -40,6 +42,49 @@ class TestDefaultColsMixin:
         assert thing.updated_utc.format() == '2020-02-01 17:03:05+00:00'
 
 
+class TestEntityMetadata:
+
+    def test_metadata(self):
+        metadata = mixins.EntityMetadata.get(ents.RelatedThing)
+
+        assert mixins.EntityMetadata.get(ents.RelatedThing) is metadata
+        assert metadata.column_keys == {'id', 'created_utc', 'updated_utc', 'name', 'is_enabled',
+                                        'thing_id'}
+        assert metadata.kwarg_keys == metadata.column_keys | {'thing'}
+        assert set(metadata.relationships) == {'thing'}
+        assert metadata.column_prop_keys == metadata.column_keys
+        assert [col.key for col in metadata.primary_keys] == ['id']
+
+    def test_metadata_column_property(self):
+        metadata = mixins.EntityMetadata.get(ents.Thing)
+
+        assert 'float_check_prop' in metadata.column_keys
+        assert 'float_check_prop' in metadata.column_prop_keys
+        assert 'related_things' in metadata.relationships
+
+    def test_invalidated_on_mapper_configure(self):
+        Base = sa.orm.declarative_base()
+
+        class Parent(mixins.MethodsMixin, Base):
+            __tablename__ = 'metadata_parents'
+            id = sa.Column(sa.Integer, primary_key=True)
+
+        metadata = mixins.EntityMetadata.get(Parent)
+        assert not metadata.relationships
+
+        class Child(mixins.MethodsMixin, Base):
+            __tablename__ = 'metadata_children'
+            id = sa.Column(sa.Integer, primary_key=True)
+            parent_id = sa.Column(sa.Integer, sa.ForeignKey(Parent.id))
+            parent = sa.orm.relationship(Parent, backref='children')
+
+        sa.orm.configure_mappers()
+
+        new_metadata = mixins.EntityMetadata.get(Parent)
+        assert new_metadata is not metadata
+        assert set(new_metadata.relationships) == {'children'}
+
+
 class TestMethodsMixin:
 
     def setup_method(self, fn):
@@ -87,6 +132,46 @@ class TestMethodsMixin:
             assert id_key == ret_id
         assert row.name == 'name'
 
+    def test_insert_many(self):
+        rows = [{'name': 'name{}'.format(i), 'color': 'color'} for i in range(5)]
+        ret_ids = ents.Thing.insert_many(rows, batch_size=2)
+        assert ents.Thing.query.count() == 5
+
+        names = [row.name for row in ents.Thing.query.order_by(ents.Thing.id)]
+        assert names == ['name0', 'name1', 'name2', 'name3', 'name4']
+
+        if db.engine.dialect.name == 'sqlite':
+            assert ret_ids is None
+        else:
+            assert ret_ids == [
+                ents.Thing.get_by(name='name{}'.format(i)).id for i in range(5)
+            ]
+
+    def test_insert_many_multiple_pk(self):
+        rows = [
+            {'name': 'name', 'id': 60, 'other_pk': 1},
+            {'name': 'name', 'id': 61, 'other_pk': 2},
+        ]
+        ret_ids = ents.MultiplePrimaryKeys.insert_many(rows)
+        assert ents.MultiplePrimaryKeys.query.count() == 2
+
+        if db.engine.dialect.name != 'sqlite':
+            if ents.MultiplePrimaryKeys.primary_keys()[0].name == 'id':
+                assert [tuple(row) for row in ret_ids] == [(60, 1), (61, 2)]
+            else:
+                assert [tuple(row) for row in ret_ids] == [(1, 60), (2, 61)]
+
+    def test_add_many(self):
+        objs = ents.Thing.add_many([{'name': 'a'}, {'name': 'b', 'color': 'red'}])
+        assert ents.Thing.query.count() == 2
+        assert [obj.name for obj in objs] == ['a', 'b']
+        assert objs[1].color == 'red'
+        assert all(obj.id for obj in objs)
+
+        with pytest.raises(AssertionError):
+            ents.Thing.add_many([{'name': 'c', 'fieldshouldnotexist': 'foo'}])
+        db.session.rollback()
+
     def test_delete(self):
         thing = ents.Thing.fake()
         assert ents.Thing.query.count() == 1
@@ -142,6 +227,34 @@ class TestMethodsMixin:
 
         assert row.name == 'bar'
 
+    def test_update_many(self):
+        things = [ents.Thing.fake(name='a{}'.format(i)) for i in range(3)]
+
+        rowcounts = ents.Thing.update_many([
+            {'id': things[0].id, 'name': 'b0', 'color': 'silver'},
+            {'id': things[1].id, 'name': 'b1', 'color': 'gold'},
+            {'id': things[2].id + 100, 'name': 'b2', 'color': 'gold'},
+        ], batch_size=2)
+        db.session.commit()
+        db.session.expire_all()
+
+        assert rowcounts == [2, 0]
+        assert (things[0].name, things[0].color) == ('b0', 'silver')
+        assert (things[1].name, things[1].color) == ('b1', 'gold')
+        assert things[2].name == 'a2'
+
+    def test_update_many_multiple_pk(self):
+        row1 = ents.MultiplePrimaryKeys.fake(id=55, other_pk=6, name='foo')
+        row2 = ents.MultiplePrimaryKeys.fake(id=55, other_pk=7, name='foo')
+
+        rowcounts = ents.MultiplePrimaryKeys.update_many([{'id': 55, 'other_pk': 7, 'name': 'bar'}])
+        db.session.commit()
+        db.session.expire_all()
+
+        assert rowcounts == [1]
+        assert row1.name == 'foo'
+        assert row2.name == 'bar'
+
     def test_from_dict(self):
         # Testing create uses `from_dict` so create objects by hand
         related = ents.RelatedThing(name='something')
@@ -179,6 +292,89 @@ class TestMethodsMixin:
         ents.MultiplePrimaryKeys.add_or_edit({'name': 'other', 'id': 1, 'other_pk': 1})
         assert obj.name == 'other'
 
+    def test_upsert_many(self):
+        thing = ents.Thing.fake(name='a', color='red')
+        updated_utc = thing.updated_utc
+
+        result = ents.Thing.upsert_many([
+            {'id': thing.id, 'name': 'b'},
+            {'id': thing.id + 1, 'name': 'c'},
+            {'id': thing.id + 2, 'name': 'd'},
+        ], batch_size=2)
+        db.session.commit()
+        db.session.expire_all()
+
+        assert result == {thing.id: 'updated', thing.id + 1: 'created', thing.id + 2: 'created'}
+        assert ents.Thing.query.count() == 3
+        assert thing.name == 'b'
+        assert thing.color == 'red'
+        assert thing.updated_utc >= updated_utc
+        assert ents.Thing.get(thing.id + 2).name == 'd'
+        assert ents.Thing.get(thing.id + 2).created_utc is not None
+
+    def test_upsert_many_duplicate_keys(self):
+        thing = ents.Thing.fake(name='a')
+
+        result = ents.Thing.upsert_many([
+            {'id': thing.id, 'name': 'b'},
+            {'id': thing.id + 1, 'name': 'c'},
+            {'id': thing.id, 'name': 'd'},
+            {'id': thing.id + 1, 'name': 'e'},
+            {'id': thing.id + 1, 'name': 'f'},
+        ], batch_size=3)
+        db.session.commit()
+        db.session.expire_all()
+
+        assert result == {thing.id: 'updated', thing.id + 1: 'created'}
+        assert ents.Thing.query.count() == 2
+        assert thing.name == 'd'
+        assert ents.Thing.get(thing.id + 1).name == 'f'
+
+    def test_upsert_many_update_columns(self):
+        thing = ents.Thing.fake(name='a', color='red')
+
+        ents.Thing.upsert_many(
+            [{'id': thing.id, 'name': 'b', 'color': 'blue'}],
+            update_columns=['color'],
+        )
+        db.session.commit()
+        db.session.expire_all()
+
+        assert thing.name == 'a'
+        assert thing.color == 'blue'
+
+    def test_upsert_many_multiple_pk(self):
+        ents.MultiplePrimaryKeys.fake(id=1, other_pk=2, name='foo')
+
+        result = ents.MultiplePrimaryKeys.upsert_many([
+            {'id': 1, 'other_pk': 2, 'name': 'bar'},
+            {'id': 1, 'other_pk': 3, 'name': 'baz'},
+        ])
+        db.session.commit()
+        db.session.expire_all()
+
+        pk_names = [col.key for col in ents.MultiplePrimaryKeys.primary_keys()]
+        expected_created = (1, 3) if pk_names == ['id', 'other_pk'] else (3, 1)
+        expected_updated = (1, 2) if pk_names == ['id', 'other_pk'] else (2, 1)
+        assert result == {expected_updated: 'updated', expected_created: 'created'}
+        assert ents.MultiplePrimaryKeys.get({'id': 1, 'other_pk': 2}).name == 'bar'
+        assert ents.MultiplePrimaryKeys.get({'id': 1, 'other_pk': 3}).name == 'baz'
+
+    def test_upsert_many_conflict_columns(self):
+        ents.LookupTester.delete_cascaded()
+        lookup = ents.LookupTester.fake(label='a', code='foo')
+
+        result = ents.LookupTester.upsert_many(
+            [{'label': 'a', 'code': 'bar'}, {'label': 'b', 'code': 'baz'}],
+            conflict_columns='label',
+        )
+        db.session.commit()
+        db.session.expire_all()
+
+        assert result == {'a': 'updated', 'b': 'created'}
+        assert lookup.code == 'bar'
+        assert ents.LookupTester.get_by_label('b').code == 'baz'
+
     def test_get(self):
         thing = ents.Thing.fake(name='banana')
         assert ents.Thing.get(thing.id).name == 'banana'
@@ -260,6 +456,238 @@ class TestMethodsMixin:
             'float_check_prop': obj.float_check_prop,
         }
 
+    def test_paginate_keyset(self):
+        things = [ents.Thing.fake(name='thing{}'.format(i)) for i in range(5)]
+
+        page = ents.Thing.paginate_keyset(limit=2)
+        assert page.items == things[:2]
+        assert page.has_next
+
+        page = ents.Thing.paginate_keyset(after=page.next_cursor, limit=2)
+        assert page.items == things[2:4]
+
+        page = ents.Thing.paginate_keyset(after=page.next_cursor, limit=2)
+        assert page.items == things[4:]
+        assert not page.has_next
+        assert page.next_cursor is None
+
+        page = ents.Thing.paginate_keyset(limit=5)
+        assert list(page) == things
+        assert not page.has_next
+
+    def test_paginate_keyset_composite_sort(self):
+        names = ['b', 'a', 'b', 'c', 'a', 'b']
+        things = [ents.Thing.fake(name=name, float_check=1) for name in names]
+        expected = sorted(things, key=lambda thing: (thing.name, -thing.id))
+
+        def fetch_all(**kwargs):
+            pages = []
+            cursor = None
+            while True:
+                page = ents.Thing.paginate_keyset(after=cursor, limit=2, **kwargs)
+                pages.append(page.items)
+                cursor = page.next_cursor
+                if cursor is None:
+                    return pages
+
+        pages = fetch_all(order_by=[ents.Thing.name, ents.Thing.id.desc()])
+        assert [len(items) for items in pages] == [2, 2, 2]
+        assert sum(pages, []) == expected
+
+        # primary key tiebreaker is added, and sort columns of other types are encoded
+        pages = fetch_all(order_by=[ents.Thing.float_check.desc(), ents.Thing.created_utc],
+                          query=ents.Thing.query.filter(ents.Thing.name != 'c'))
+        assert sum(pages, []) == sorted(
+            [thing for thing in things if thing.name != 'c'],
+            key=lambda thing: (thing.created_utc, thing.id)
+        )
+
+    def test_paginate_keyset_attribute_names(self):
+        things = [ents.Thing.fake(name=name) for name in ['b', 'a', 'c']]
+
+        page = ents.Thing.paginate_keyset(order_by=['name'], limit=2)
+        assert page.items == [things[1], things[0]]
+        page = ents.Thing.paginate_keyset(order_by=['name'], after=page.next_cursor, limit=2)
+        assert page.items == [things[2]]
+
+        with pytest.raises(ValueError, match="Unknown column name for sort: 'nope'"):
+            ents.Thing.paginate_keyset(order_by=['nope'])
+
+    def test_paginate_keyset_invalid_cursor(self):
+        ents.Thing.fake()
+
+        with pytest.raises(ValueError, match='Invalid cursor'):
+            ents.Thing.paginate_keyset(after='foo')
+
+        cursor = dbutils.encode_cursor([1, 2])
+        with pytest.raises(ValueError, match='Invalid cursor'):
+            ents.Thing.paginate_keyset(after=cursor)
+
+    @pytest.mark.parametrize('by', ['pk', 'stream'])
+    def test_iter_chunks(self, by):
+        thing_ids = [ents.Thing.fake(name='thing{}'.format(i)).id for i in range(5)]
+        db.session.remove()
+
+        chunks = []
+        for chunk in ents.Thing.iter_chunks(chunk_size=2, by=by):
+            chunks.append(chunk)
+            for thing in chunk:
+                thing.color = 'chunked'
+
+        assert [[thing.id for thing in chunk] for chunk in chunks] == [
+            thing_ids[:2], thing_ids[2:4], thing_ids[4:]
+        ]
+        assert all(sa.inspect(thing).detached for chunk in chunks for thing in chunk)
+        assert not list(db.session.identity_map.values())
+
+        db.session.commit()
+        assert {thing.color for thing in ents.Thing.query} == {'chunked'}
+
+    def test_iter_chunks_query(self):
+        for name in ('a', 'b', 'a', 'a'):
+            ents.Thing.fake(name=name)
+
+        chunks = list(ents.Thing.iter_chunks(
+            query=ents.Thing.query.filter_by(name='a'), chunk_size=2, expunge=False
+        ))
+        assert [len(chunk) for chunk in chunks] == [2, 1]
+        assert all(sa.inspect(thing).persistent for chunk in chunks for thing in chunk)
+
+        with pytest.raises(ValueError):
+            list(ents.Thing.iter_chunks(by='offset'))
+
+    def test_iter_dicts(self):
+        things = [ents.Thing.fake(name='thing{}'.format(i)) for i in range(5)]
+
+        rows = list(ents.Thing.iter_dicts(chunk_size=2))
+        assert sorted(rows, key=lambda row: row['id']) == [thing.to_dict() for thing in things]
+
+        rows = ents.Thing.iter_dicts(
+            ents.Thing.query.filter(ents.Thing.name != 'thing0').order_by(ents.Thing.id.desc()),
+            columns=['id', 'name_and_color'],
+        )
+        assert list(rows) == [
+            {'id': thing.id, 'name_and_color': thing.name_and_color} for thing in things[:0:-1]
+        ]
+
+        rows = ents.Thing.iter_dicts(
+            sa.select(ents.Thing).where(ents.Thing.name == 'thing1'),
+            columns=['name'],
+            named_tuples=True,
+        )
+        row, = rows
+        assert row.name == 'thing1'
+
+    def test_serializer(self):
+        obj = ents.Thing.fake()
+
+        serializer = ents.Thing.serializer()
+        assert ents.Thing.serializer() is serializer
+        assert serializer(obj) == obj.to_dict()
+
+        serializer = ents.Thing.serializer(include=['id', 'name', 'name_and_color'])
+        assert serializer(obj) == {
+            'id': obj.id,
+            'name': obj.name,
+            'name_and_color': obj.name_and_color,
+        }
+        assert serializer.many([obj]) == [serializer(obj)]
+
+        serializer = ents.Thing.serializer(include=['name'], exclude={'name'})
+        assert serializer(obj) == {}
+
+        with pytest.raises(ValueError, match='Unknown attribute names'):
+            ents.Thing.serializer(include=['foo'])
+
+        with pytest.raises(ValueError, match='Unknown relationship name'):
+            ents.Thing.serializer(nested={'name': None})
+
+    def test_serializer_nested(self):
+        thing1 = ents.Thing.fake(name='a')
+        related1 = ents.RelatedThing.fake(thing=thing1, name='x')
+        related2 = ents.RelatedThing.fake(thing=thing1, name='y')
+        thing2 = ents.Thing.fake(name='b')
+
+        serializer = ents.Thing.serializer(
+            include=['id', 'name'],
+            nested={'related_things': {'include': ['id', 'name']}},
+        )
+        db.session.expire_all()
+        data = serializer.all(ents.Thing.query.order_by(ents.Thing.id))
+        assert data == [
+            {
+                'id': thing1.id,
+                'name': 'a',
+                'related_things': [
+                    {'id': related1.id, 'name': 'x'},
+                    {'id': related2.id, 'name': 'y'},
+                ],
+            },
+            {'id': thing2.id, 'name': 'b', 'related_things': []},
+        ]
+
+        serializer = ents.RelatedThing.serializer(
+            include=['name'],
+            nested={'thing': {'include': ['name']}},
+        )
+        data = serializer.all(ents.RelatedThing.query.order_by(ents.RelatedThing.id))
+        assert data == [
+            {'name': 'x', 'thing': {'name': 'a'}},
+            {'name': 'y', 'thing': {'name': 'a'}},
+        ]
+
+    def test_serializer_avoids_lazy_loads(self):
+        for _ in range(3):
+            thing = ents.Thing.fake()
+            ents.RelatedThing.fake(thing=thing)
+            ents.RelatedThing.fake(thing=thing)
+        db.session.expire_all()
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        serializer = ents.RelatedThing.serializer(
+            include=['id', 'name'],
+            nested={'thing': {'include': ['name'], 'nested': {'related_things': None}}},
+        )
+        sa.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            data = serializer.all()
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+        assert len(data) == 6
+        assert all(len(row['thing']['related_things']) == 2 for row in data)
+        assert len(statements) == 3
+
+    @pytest.mark.parametrize('load', [None, ['name', 'color']])
+    def test_serializer_hybrid_avoids_lazy_loads(self, load):
+        for _ in range(3):
+            ents.Thing.fake()
+        db.session.expire_all()
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        serializer = ents.Thing.serializer(include=['id', 'name_and_color'], load=load)
+        sa.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            data = serializer.all()
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+        assert len(data) == 3
+        assert all(row['name_and_color'] for row in data)
+        assert len(statements) == 1
+
+    def test_serializer_invalid_load(self):
+        with pytest.raises(ValueError, match='Unknown column names'):
+            ents.Thing.serializer(include=['id', 'name_and_color'], load=['nope'])
+
     def test_random_data_for_column(self):
         func = mixins.MethodsMixin.random_data_for_column
 
@@ -307,6 +735,63 @@ class TestMethodsMixin:
         db.session.remove()
         ents.Thing.add(name='kwargs-in-add', fieldshouldnotexist='foo', _check_kwargs=False)
 
+    def test_fake_many(self):
+        ents.Thing.fake_many(25, _batch_size=10, float_check=1.5)
+        assert ents.Thing.query.count() == 25
+
+        thing = ents.Thing.query.first()
+        assert thing.name
+        assert thing.color == 'blue'
+        assert thing.float_check == 1.5
+        assert thing.created_utc
+
+        with pytest.raises(AssertionError, match='Unknown column names'):
+            ents.Thing.fake_many(1, foo=1)
+
+    def test_fake_many_seed(self):
+        def names():
+            return [thing.name for thing in ents.Thing.query.order_by(ents.Thing.id)]
+
+        ents.Thing.fake_many(5, _seed=42)
+        first_names = names()
+        ents.Thing.delete_cascaded()
+
+        ents.Thing.fake_many(5, _seed=42)
+        assert names() == first_names
+        ents.Thing.delete_cascaded()
+
+        ents.Thing.fake_many(5, _seed=43)
+        assert names() != first_names
+
+    def test_fake_many_callable_kwarg(self):
+        counter = iter(range(3))
+        ents.Thing.fake_many(3, name=lambda: 'thing{}'.format(next(counter)))
+        assert [thing.name for thing in ents.Thing.query.order_by(ents.Thing.id)] == [
+            'thing0', 'thing1', 'thing2'
+        ]
+
+    def test_fake_many_parent_pool(self):
+        ents.RelatedThing.fake_many(20, _parent_pool_size=3)
+        assert ents.RelatedThing.query.count() == 20
+        assert ents.Thing.query.count() == 3
+
+        thing = ents.Thing.fake()
+        ents.RelatedThing.fake_many(5, thing_id=thing.id)
+        assert len(thing.related_things) == 5
+
+    def test_fake_many_no_commit(self):
+        ents.Thing.fake(name='pending', _commit=False)
+        ents.RelatedThing.fake_many(2, _parent_pool_size=2, _commit=False)
+        assert ents.RelatedThing.query.count() == 2
+        db.session.rollback()
+
+        assert ents.Thing.query.count() == 0
+        assert ents.RelatedThing.query.count() == 0
+
+    def test_fake_many_multi_column_foreign_key(self):
+        with pytest.raises(ValueError, match='multi-column foreign key'):
+            ents.UsesBoth.fake_many(1)
+
     def test_testing_create_flush_and_commit(self):
         obj = ents.Thing.fake(_flush=False, _commit=False)
         assert sa.inspect(obj).pending
@@ -399,6 +884,133 @@ class TestSoftDeleteMixin:
 
         db.session.rollback()
 
+    def test_fake_many(self):
+        ents.SoftDeleteTester.fake_many(3)
+        ents.SoftDeleteTester.fake_many(2, _is_deleted=True)
+
+        assert ents.SoftDeleteTester.query.filter(
+            ents.SoftDeleteTester.deleted_utc.is_(None)
+        ).count() == 3
+        assert ents.SoftDeleteTester.query.count() == 5
+
+    def test_delete_many(self):
+        sdts = [ents.SoftDeleteTester.fake() for _ in range(5)]
+        deleted = ents.SoftDeleteTester.fake(_is_deleted=True)
+        deleted_utc = deleted.deleted_utc
+
+        count = ents.SoftDeleteTester.delete_many(
+            [sdt.id for sdt in sdts[:3]] + [deleted.id],
+            batch_size=2,
+        )
+        assert count == 3
+        assert [sdt.deleted_utc is not None for sdt in sdts] == [True, True, True, False, False]
+        assert deleted.deleted_utc == deleted_utc
+
+        count = ents.SoftDeleteTester.delete_many(ents.SoftDeleteTester.id == sdts[3].id)
+        assert count == 1
+        assert sdts[3].deleted_utc is not None
+
+        count = ents.SoftDeleteTester.restore_many([sdt.id for sdt in sdts])
+        assert count == 4
+        assert all(sdt.deleted_utc is None for sdt in sdts)
+
+        count = ents.SoftDeleteTester.restore_many(ents.SoftDeleteTester.id == deleted.id)
+        assert count == 1
+        assert deleted.deleted_utc is None
+
+    def test_delete_many_multiple_pk(self):
+        ents.SoftDeleteMultipleKeys.delete_cascaded()
+        row1 = ents.SoftDeleteMultipleKeys.fake(id=1, other_pk=1)
+        row2 = ents.SoftDeleteMultipleKeys.fake(id=1, other_pk=2)
+        row3 = ents.SoftDeleteMultipleKeys.fake(id=2, other_pk=1)
+
+        # same records whichever order the primary key columns are in
+        ids = [(1, 2), (2, 1)]
+        assert ents.SoftDeleteMultipleKeys.delete_many(ids) == 2
+        assert row1.deleted_utc is None
+        assert row2.deleted_utc is not None
+        assert row3.deleted_utc is not None
+
+        assert ents.SoftDeleteMultipleKeys.restore_many(ids) == 2
+        assert row2.deleted_utc is None
+
+    def test_active_query(self):
+        sdt1 = ents.SoftDeleteTester.fake()
+        sdt2 = ents.SoftDeleteTester.fake(_is_deleted=True)
+
+        assert ents.SoftDeleteTester.active_query().all() == [sdt1]
+        assert ents.SoftDeleteTester.active_query().filter_by(id=sdt2.id).count() == 0
+        assert ents.SoftDeleteTester.query.count() == 2
+
+        query = mixins.SoftDeleteMixin.with_deleted(ents.SoftDeleteTester.active_query())
+        assert query.count() == 2
+
+    def test_active_query_relationship_loads(self):
+        parent = ents.HardDeleteParent.fake()
+        sdt1 = ents.SoftDeleteTester.add(hdp=parent)
+        ents.SoftDeleteTester.add(hdp=parent, deleted_utc=arrow.utcnow())
+        db.session.expire_all()
+
+        parent = ents.HardDeleteParent.query.options(
+            sa.orm.selectinload(ents.HardDeleteParent.sdts)
+        ).execution_options(active_only=True).one()
+        assert parent.sdts == [sdt1]
+
+    def test_default_active_only(self, monkeypatch):
+        monkeypatch.setattr(ents.SoftDeleteTester, 'default_active_only', True)
+        parent_id = ents.HardDeleteParent.fake().id
+        sdt1_id = ents.SoftDeleteTester.add(hdp_id=parent_id).id
+        sdt2_id = ents.SoftDeleteTester.add(hdp_id=parent_id, deleted_utc=arrow.utcnow()).id
+        db.session.remove()
+
+        assert [sdt.id for sdt in ents.SoftDeleteTester.query] == [sdt1_id]
+        assert ents.SoftDeleteTester.get(sdt2_id) is None
+        assert [sdt.id for sdt in ents.HardDeleteParent.get(parent_id).sdts] == [sdt1_id]
+        assert mixins.SoftDeleteMixin.with_deleted(ents.SoftDeleteTester.query).count() == 2
+
+        # refreshing expired attributes of a loaded record is not filtered
+        sdt2 = mixins.SoftDeleteMixin.with_deleted(ents.SoftDeleteTester.query).filter_by(
+            id=sdt2_id).one()
+        db.session.expire(sdt2)
+        assert sdt2.deleted_utc is not None
+
+    def test_criteria_not_applied(self):
+        statements = []
+
+        def record_statement(orm_execute_state):
+            statements.append(orm_execute_state.statement)
+
+        stmt = sa.select(ents.Thing)
+        sa.event.listen(db.session, 'do_orm_execute', record_statement)
+        try:
+            db.session.execute(stmt).all()
+        finally:
+            sa.event.remove(db.session, 'do_orm_execute', record_statement)
+
+        # statements not needing soft-delete criteria are passed through unchanged
+        assert statements == [stmt]
+
+    def test_active_index(self):
+        table = sa.Table(
+            'active_index_table',
+            sa.MetaData(),
+            sa.Column('name', sa.Unicode),
+            sa.Column('deleted_utc', sa.DateTime),
+            mixins.SoftDeleteMixin.active_index('ix_active_name', 'name'),
+        )
+        index, = table.indexes
+
+        def compile_index(dialect_name):
+            dialect = getattr(sa.dialects, dialect_name).dialect()
+            return str(sa.schema.CreateIndex(index).compile(dialect=dialect))
+
+        assert compile_index('postgresql') == \
+            'CREATE INDEX ix_active_name ON active_index_table (name) WHERE deleted_utc IS NULL'
+        assert compile_index('sqlite') == \
+            'CREATE INDEX ix_active_name ON active_index_table (name) WHERE deleted_utc IS NULL'
+        assert compile_index('mssql') == \
+            'CREATE INDEX ix_active_name ON active_index_table (name) WHERE deleted_utc IS NULL'
+
     def test_delete_without_id_returns_none(self):
         assert not ents.SoftDeleteTester.delete(1234)
 
@@ -478,6 +1090,153 @@ class TestLookupMixin:
         pairs = ents.LookupTester.pairs_active(include_ids=(d.id, e.id))
         assert make_pairs(a, b, c, d, e) == pairs
 
+    def test_pairs_active_cached(self, monkeypatch):
+        monkeypatch.setattr(ents.LookupTester, 'lookup_cache_ttl', 60)
+        mixins.lookup_cache.invalidate()
+        a = ents.LookupTester.fake(label='a', deleted_utc=None)
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sa.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            assert ents.LookupTester.pairs_active() == [(a.id, 'a')]
+            assert ents.LookupTester.pairs_active() == [(a.id, 'a')]
+            assert len(statements) == 1
+
+            # separate entries for include_ids and order_by
+            ents.LookupTester.pairs_active(include_ids=[a.id])
+            ents.LookupTester.pairs_active(order_by=ents.LookupTester.label.desc())
+            ents.LookupTester.pairs_active(order_by=ents.LookupTester.label.desc())
+            assert len(statements) == 3
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+        # ORM insert
+        b = ents.LookupTester.fake(label='b', deleted_utc=None)
+        assert ents.LookupTester.pairs_active() == [(a.id, 'a'), (b.id, 'b')]
+
+        # bulk soft delete
+        ents.LookupTester.delete(b.id)
+        assert ents.LookupTester.pairs_active() == [(a.id, 'a')]
+
+        # ORM update
+        a.label = 'c'
+        db.session.commit()
+        assert ents.LookupTester.pairs_active() == [(a.id, 'c')]
+
+        # Core insert
+        ents.LookupTester.insert(label='d')
+        db.session.commit()
+        assert [label for _, label in ents.LookupTester.pairs_active()] == ['c', 'd']
+
+    def test_pairs_active_cache_ttl(self, monkeypatch):
+        monkeypatch.setattr(ents.LookupTester, 'lookup_cache_ttl', 60)
+        ents.LookupTester.fake(label='a', deleted_utc=None)
+        assert len(ents.LookupTester.pairs_active()) == 1
+
+        # write the table outside the session, which cache invalidation can't see
+        with db.engine.begin() as conn:
+            conn.execute(sa.insert(ents.LookupTester.__table__).values(label='b'))
+        assert len(ents.LookupTester.pairs_active()) == 1
+
+        now = time.monotonic()
+        monkeypatch.setattr(mixins.time, 'monotonic', lambda: now + 61)
+        assert len(ents.LookupTester.pairs_active()) == 2
+
+    def test_pairs_active_not_cached_by_default(self):
+        a = ents.LookupTester.fake(label='a', deleted_utc=None)
+        assert ents.LookupTester.pairs_active() == [(a.id, 'a')]
+
+        with db.engine.begin() as conn:
+            conn.execute(sa.insert(ents.LookupTester.__table__).values(label='b'))
+        assert len(ents.LookupTester.pairs_active()) == 2
+
+    def test_lookup_cache_skips_stale_value(self):
+        cache = mixins.LookupCache()
+
+        def creator():
+            cache.invalidate(ents.LookupTester)
+            return 'stale'
+
+        assert cache.get_or_create(ents.LookupTester, 'key', 60, creator) == 'stale'
+        assert cache.get_or_create(ents.LookupTester, 'key', 60, lambda: 'fresh') == 'fresh'
+        assert cache.get_or_create(ents.LookupTester, 'key', 60, lambda: 'other') == 'fresh'
+
+    def test_is_active(self):
+        a = ents.LookupTester.fake(label='a', deleted_utc=None)
+        b = ents.LookupTester.fake(label='b', deleted_utc=arrow.now())
+
+        assert a.is_active
+        assert not b.is_active
+
+        query = ents.LookupTester.query.order_by(ents.LookupTester.label)
+        assert query.filter(ents.LookupTester.is_active == sa.true()).all() == [a]
+        assert query.filter(ents.LookupTester.is_active == True).all() == [a]  # noqa: E712
+        assert query.filter(ents.LookupTester.is_active != sa.true()).all() == [b]
+        assert query.filter(ents.LookupTester.is_active.is_(False)).all() == [b]
+
+        rows = db.session.execute(
+            sa.select(ents.LookupTester.label, ents.LookupTester.is_active)
+            .order_by(ents.LookupTester.label)
+        ).all()
+        assert [tuple(row) for row in rows] == [('a', True), ('b', False)]
+
+    def test_is_active_sargable(self):
+        def compile_clause(clause):
+            return str(clause.compile(db.engine))
+
+        assert compile_clause(ents.LookupTester.is_active == sa.true()) == \
+            'lookup_tester.deleted_utc IS NULL'
+        assert compile_clause(ents.LookupTester.is_active == sa.false()) == \
+            'lookup_tester.deleted_utc IS NOT NULL'
+
+        where = ents.LookupTester._active_query(include_ids=[1, 2]).statement.whereclause
+        assert compile_clause(where) == \
+            'lookup_tester.deleted_utc IS NULL OR lookup_tester.id IN (__[POSTCOMPILE_id_1])'
+
+    def test_active_query_uses_index(self):
+        """Benchmark the active lookup query plan against the CASE based expression."""
+        dialect_name = db.engine.dialect.name
+        if dialect_name not in ('sqlite', 'postgresql'):
+            pytest.skip('SQLite and Postgres only test')
+
+        index = sa.Index('ix_lookup_tester_deleted_utc', ents.LookupTester.deleted_utc)
+        old_clause = sa.sql.case(
+            (ents.LookupTester.deleted_utc.is_(None), sa.true()), else_=sa.false()
+        ) == sa.true()
+
+        def query_plan(stmt):
+            sql = str(stmt.compile(db.engine, compile_kwargs={'literal_binds': True}))
+            if dialect_name == 'sqlite':
+                plan = db.session.execute(sa.text('EXPLAIN QUERY PLAN ' + sql)).all()
+                return ' '.join(row[-1] for row in plan)
+            plan = db.session.execute(sa.text('EXPLAIN ' + sql)).all()
+            return ' '.join(row[0] for row in plan)
+
+        with db.engine.begin() as conn:
+            index.create(conn)
+        try:
+            if dialect_name == 'postgresql':
+                # the test table is too small for the planner to prefer an index on its own
+                db.session.execute(sa.text('SET LOCAL enable_seqscan = off'))
+
+            stmt = ents.LookupTester._active_query(order_by=ents.LookupTester.id).statement
+            assert 'ix_lookup_tester_deleted_utc' in query_plan(stmt)
+
+            stmt = ents.LookupTester._active_query(
+                include_ids=[1, 2], order_by=ents.LookupTester.id).statement
+            assert 'ix_lookup_tester_deleted_utc' in query_plan(stmt)
+
+            stmt = sa.select(ents.LookupTester).where(old_clause)
+            assert 'ix_lookup_tester_deleted_utc' not in query_plan(stmt)
+        finally:
+            db.session.rollback()
+            with db.engine.begin() as conn:
+                index.drop(conn)
+
     def test_get_by_label(self):
         a = ents.LookupTester.fake(label='a', deleted_utc=None)
         b = ents.LookupTester.fake(label='b', deleted_utc=None)
@@ -491,6 +1250,50 @@ class TestLookupMixin:
 
         assert ents.LookupTester.get_by_code('foo') == a
 
+    def test_get_by_code_and_label_cached(self, monkeypatch):
+        monkeypatch.setattr(ents.LookupTester, 'lookup_cache_ttl', 60)
+        a = ents.LookupTester.fake(label='a', code='foo', deleted_utc=None)
+        b = ents.LookupTester.fake(label='b', deleted_utc=None)
+        ents.LookupTester.fake(label='c', code='dupe', deleted_utc=None)
+        ents.LookupTester.fake(label='d', code='dupe', deleted_utc=None)
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sa.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            def lookups():
+                assert ents.LookupTester.get_by_code('foo') is a
+                assert ents.LookupTester.get_by_label('b') is b
+                assert ents.LookupTester.get_by_code('bar') is None
+                assert ents.LookupTester.get_by_label('z') is None
+
+            # index load, and refreshes of the records expired by commit
+            lookups()
+            assert len(statements) == 3
+
+            # identity map hits
+            statements.clear()
+            lookups()
+            lookups()
+            assert not statements
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+        with pytest.raises(sa.orm.exc.MultipleResultsFound):
+            ents.LookupTester.get_by_code('dupe')
+
+        # re-attaches in a new session
+        db.session.remove()
+        assert ents.LookupTester.get_by_code('foo').id == a.id
+
+        b = ents.LookupTester.get_by_label('b')
+        b.code = 'bar'
+        db.session.commit()
+        assert ents.LookupTester.get_by_code('bar') is b
+
     def test_repr(self):
         a = ents.LookupTester.fake(label='a', deleted_utc=None)
         assert str(a) == '<LookupTester {}:a>'.format(a.id)
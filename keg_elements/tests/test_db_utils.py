@@ -1,8 +1,11 @@
+import datetime
 from decimal import Decimal
 import sys
+import uuid
 from unittest import mock
 
 import _pytest
+import arrow
 import pytest
 import validators
 import keg
@@ -35,6 +38,84 @@ def test_randemail():
         'randemail not random (beware non-determinism; try again)'
 
 
+def test_chunked():
+    assert list(dbutils.chunked([], 2)) == []
+    assert list(dbutils.chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(dbutils.chunked(iter(range(4)), 2)) == [[0, 1], [2, 3]]
+
+    with pytest.raises(ValueError):
+        list(dbutils.chunked(range(5), 0))
+
+
+def test_encode_decode_cursor():
+    values = [
+        1, 'a', None, 1.5, True,
+        Decimal('1.25'),
+        datetime.date(2020, 1, 2),
+        datetime.datetime(2020, 1, 2, 3, 4, 5),
+        datetime.time(3, 4, 5, 6),
+        uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        arrow.get('2020-01-02T03:04:05+00:00'),
+    ]
+    cursor = dbutils.encode_cursor(values)
+    assert '=' not in cursor
+    assert dbutils.decode_cursor(cursor) == values
+
+    assert dbutils.decode_cursor(dbutils.encode_cursor([ents.Units.feet])) == ['feet']
+
+    for value in (b'bytes', [1], {'a': 1}, object()):
+        with pytest.raises(ValueError, match='Unsupported cursor value type'):
+            dbutils.encode_cursor([value])
+
+    for cursor in ('foo', '', dbutils.encode_cursor([1])[:-2], 'W1siZm9vIiwiYmFyIl1d'):
+        with pytest.raises(ValueError, match='Invalid cursor'):
+            dbutils.decode_cursor(cursor)
+
+
+def test_columns_in():
+    table = sa.Table('in_table', sa.MetaData(), sa.Column('a', sa.Integer),
+                     sa.Column('b', sa.Integer))
+
+    clause = dbutils.columns_in([table.c.a], [1, 2])
+    assert str(clause.compile(compile_kwargs={'literal_binds': True})) == 'in_table.a IN (1, 2)'
+
+    clause = dbutils.columns_in([table.c.a, table.c.b], [(1, 2), (3, 4)])
+    assert str(clause.compile(compile_kwargs={'literal_binds': True})) == \
+        '(in_table.a, in_table.b) IN ((1, 2), (3, 4))'
+
+
+def test_mssql_merge():
+    table = sa.Table(
+        'merge_table',
+        sa.MetaData(),
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.Unicode),
+        sa.Column('color', sa.Unicode, default='blue'),
+        sa.Column('updated', sa.Integer, onupdate=5),
+    )
+    stmt = dbutils.mssql_merge(
+        sa.dialects.mssql.dialect(),
+        table,
+        [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}],
+        ['id'],
+        ['name'],
+        {'updated': 5},
+    )
+
+    assert str(stmt).splitlines() == [
+        'MERGE INTO merge_table WITH (HOLDLOCK) AS target',
+        'USING (VALUES (:v0_0, :v0_1, :v0_2), (:v1_0, :v1_1, :v1_2)) AS source (id, name, color)',
+        'ON target.id = source.id',
+        'WHEN MATCHED THEN UPDATE SET target.name = source.name, target.updated = :u0',
+        'WHEN NOT MATCHED THEN INSERT (id, name, color) VALUES '
+        '(source.id, source.name, source.color);',
+    ]
+    params = stmt.compile().params
+    assert params['v0_2'] == 'blue'
+    assert params['v1_1'] == 'b'
+    assert params['u0'] == 5
+
+
 class TestUpdateCollection(object):
 
     def setup_method(self, method):
@@ -103,6 +184,33 @@ class TestUpdateCollection(object):
 
         assert len(thing.related_things) == 0
 
+    def test_edit_remove_add(self):
+        thing = ents.Thing.fake()
+        related_ids = [
+            ents.RelatedThing.fake(thing=thing, name='a{}'.format(i)).id for i in range(20)
+        ]
+
+        data = [{'id': related_id, 'name': 'b'} for related_id in related_ids[::2]]
+        data.append({'name': 'new', 'is_enabled': True})
+        thing.update_collection('related_things', data)
+        keg.db.db.session.flush()
+
+        assert len(thing.related_things) == 11
+        assert [related.id for related in thing.related_things[:10]] == related_ids[::2]
+        assert {related.name for related in thing.related_things[:10]} == {'b'}
+        assert thing.related_things[10].name == 'new'
+        assert ents.RelatedThing.query.count() == 11
+
+    def test_find_child_uses_index(self):
+        thing = ents.Thing.fake()
+        related = ents.RelatedThing.fake(thing=thing, name='a')
+
+        updater = dbutils.CollectionUpdater(thing, 'related_things', [])
+        assert updater.find_child({'id': related.id}) is related
+        assert updater.find_child({'id': related.id + 1}) is None
+        assert updater.find_child({'name': 'a'}) is None
+        assert updater.child_index == {(related.id,): related}
+
     def test_replace_with_unique_constraint(self):
         thing = ents.Thing.fake()
         other = ents.OtherThing.fake(thing=thing)
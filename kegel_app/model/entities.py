@@ -171,6 +171,9 @@ def super_secure_decrypt(data, key):
     return codecs.encode(data.decode(), 'rot_13')
 
 
+rotating_keys = [b'd' * 32]
+
+
 class ColumnTester(mixins.DefaultMixin, db.Model):
     __tablename__ = 'column_tester'
 
@@ -182,6 +185,7 @@ class ColumnTester(mixins.DefaultMixin, db.Model):
         encrypt=super_secure_encrypt,
         decrypt=super_secure_decrypt
     ))
+    encrypted4 = db.Column(columns.EncryptedUnicode(key=lambda: rotating_keys))
 
 
 class AncillaryA(mixins.DefaultMixin, db.Model):
@@ -306,6 +310,12 @@ class SoftDeleteTester(mixins.SoftDeleteMixin, mixins.DefaultMixin, db.Model):
         return super().fake(**kwargs)
 
 
+class SoftDeleteMultipleKeys(mixins.SoftDeleteMixin, mixins.DefaultMixin, db.Model):
+    __tablename__ = 'softdelete_multikey'
+
+    other_pk = db.Column(db.Integer, primary_key=True)
+
+
 class DefaultNumeric(mixins.DefaultMixin, db.Model):
     __tablename__ = 'default_numeric'
 
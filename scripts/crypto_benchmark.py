@@ -0,0 +1,56 @@
+"""Compare throughput of the file encryption helpers in keg_elements.crypto.
+
+Usage: python scripts/crypto_benchmark.py [--size-mb 256] [--workers 1 2 4 8]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from keg_elements import crypto
+
+KEY = os.urandom(32)
+
+
+def timed(label, size, func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print(f'{label:<40} {size / elapsed / 2 ** 20:10.1f} MB/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--chunk-kb', type=int, default=1024)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    size = args.size_mb * 2 ** 20
+    chunksize = args.chunk_kb * 1024
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        in_fpath = os.path.join(tmpdir, 'plain')
+        with open(in_fpath, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(2 ** 20))
+
+        enc_fpath = os.path.join(tmpdir, 'cbc.enc')
+        out_fpath = os.path.join(tmpdir, 'cbc.out')
+        timed('encrypt_file (CBC)', size, crypto.encrypt_file, KEY, in_fpath, enc_fpath,
+              chunksize=chunksize)
+        timed('decrypt_file (CBC)', size, crypto.decrypt_file, KEY, enc_fpath, out_fpath,
+              chunksize=chunksize)
+
+        for workers in args.workers:
+            enc_fpath = os.path.join(tmpdir, f'gcm-{workers}.enc')
+            out_fpath = os.path.join(tmpdir, f'gcm-{workers}.out')
+            timed(f'encrypt_stream_file (GCM, {workers} workers)', size,
+                  crypto.encrypt_stream_file, KEY, in_fpath, enc_fpath, chunksize=chunksize,
+                  workers=workers)
+            timed(f'decrypt_stream_file (GCM, {workers} workers)', size,
+                  crypto.decrypt_stream_file, KEY, enc_fpath, out_fpath, workers=workers)
+
+
+if __name__ == '__main__':
+    main()